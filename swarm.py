@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# version 1.0.0
+
+# Single entry point for the SWARM scripts, one subcommand per stage:
+#   fetch     download the new messages, queue their records and ACK them
+#             (Hive only, no SQL connection)
+#   raw       fetch, then write the queued records to the 'raw' (and
+#             'clean') SQL databases, or only write the queue with --no-fetch
+#   clean     push the new 'raw' records of each station to 'clean'
+#   backfill  fill the missing hours of a station (see swarm_coverage.py)
+#   status    cursor, queued records and export watermark of each station
+#
+# Nothing heavier than the standard library is imported before a
+# subcommand runs (the station names and file paths come from
+# swarm_paths.py), and SQL and Hive are only connected by the subcommands
+# that use them, so 'status' answers in a few tens of milliseconds. The
+# same stages can be called as functions (fetch(), raw(), clean(),
+# backfill(), status()) to schedule or time them inside one process:
+#
+# python swarm.py raw --stations steph6 upperrussell
+# python swarm.py clean --workers 3
+# python swarm.py backfill steph6 --start 2023-01-01 --hive
+# python swarm.py status
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+from datetime import datetime, timezone
+
+from swarm_paths import CURSOR_PATH, EXPORT_INDEX, QUEUE_PATH, STATION_NAMES
+
+# extra arguments of swarm_ingest.run(), Hive's own address by default
+def hive_options(base_url):
+    return {} if base_url is None else {'base_url': base_url}
+
+# download the new messages of 'stations', commit their records to the
+# local write queue and ACK them. Returns the records queued per station
+def fetch(loginParams, stations=None, cursor_path=CURSOR_PATH, queue_path=QUEUE_PATH, base_url=None):
+    import swarm_ingest
+
+    return swarm_ingest.run(None, loginParams, stations, cursor_path=cursor_path,
+                            queue_path=queue_path, write=False, **hive_options(base_url))
+
+# fetch() then write the queued records to SQL, or only write the queue if
+# 'loginParams' is None. Returns the raw records written per station
+def raw(engine, loginParams=None, stations=None, cursor_path=CURSOR_PATH, queue_path=QUEUE_PATH, base_url=None):
+    import swarm_ingest
+    import swarm_metrics
+    import swarm_queue
+
+    if loginParams is not None:
+        return swarm_ingest.run(engine, loginParams, stations, cursor_path=cursor_path,
+                                queue_path=queue_path, **hive_options(base_url))
+    results = swarm_queue.flush(engine, swarm_queue.WriteQueue(queue_path), stations)
+    swarm_metrics.flush()
+    return results
+
+# push the new 'raw' records of 'stations' to 'clean', on 'engine' (a new
+# connection if None). Returns the rows written or the error raised per
+# station. With 'workers' > 1 the stations are cleaned at the same time,
+# each in its own process with its own connection, and 'engine' is not
+# used (see swarm_clean.clean_stations() for the results)
+def clean(engine=None, stations=None, workers=1):
+    import swarm_clean
+
+    if workers > 1:
+        return swarm_clean.clean_stations(connect_sql, stations, workers)
+    if engine is None:
+        engine = connect_sql()
+    results = {}
+    for name in stations or STATION_NAMES:
+        try:
+            results[name] = swarm_clean.clean_station(engine, name)
+        except Exception as err:
+            print('Clean failed for %s: %r' %(name, err))
+            results[name] = err
+    return results
+
+# fill the missing hours of station 'name' from the local archive (and Hive
+# if 'loginParams' is given). Returns the gaps still left on raw
+def backfill(engine, name, start=None, end=None, loginParams=None):
+    import swarm_coverage
+
+    return swarm_coverage.backfill(engine, name, start, end, loginParams)
+
+def query(path, sql):
+    if not os.path.exists(path):
+        return []
+    db = sqlite3.connect(path, timeout=60)
+    try:
+        return db.execute(sql).fetchall()
+    finally:
+        db.close()
+
+def timestamp(ns):
+    if ns is None:
+        return None
+    return datetime.fromtimestamp(ns/1e9, timezone.utc).strftime('%Y-%m-%d %H:%M')
+
+# newest message processed, records waiting in the queue and last record
+# exported of each station, from the local files only
+def status(stations=None, cursor_path=CURSOR_PATH, queue_path=QUEUE_PATH, export_index=EXPORT_INDEX):
+    cursor = {}
+    if os.path.exists(cursor_path):
+        with open(cursor_path) as f:
+            cursor = json.load(f)
+    queued = {name: (n, first, last) for name, n, first, last in
+              query(queue_path, 'SELECT station, COUNT(*), MIN(dt), MAX(dt) FROM queue GROUP BY station')}
+    exported = dict(query(export_index, 'SELECT station, last FROM exported'))
+
+    result = {}
+    for name in stations or STATION_NAMES:
+        n, first, last = queued.get(name, (0, None, None))
+        result[name] = {'cursor': cursor.get(name),
+                        'queued': n, 'queued_first': timestamp(first), 'queued_last': timestamp(last),
+                        'exported': timestamp(exported.get(name))}
+    return result
+
+# Establish a connection with MySQL database 'viuhydro_wx_data_v2'
+# Server log-in details stored in config file
+def connect_sql():
+    import config
+    return config.main_sql()
+
+def login_params():
+    import config
+    return config.main_swarm()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Download, write and clean the SWARM wx station data')
+    sub = parser.add_subparsers(dest='command')
+    fet = sub.add_parser('fetch', help='download the new messages and queue their records')
+    rw = sub.add_parser('raw', help="fetch and write the records to the 'raw' SQL databases")
+    rw.add_argument('--no-fetch', action='store_true', help='only write the records already queued')
+    cln = sub.add_parser('clean', help="push the new 'raw' records to the 'clean' SQL databases")
+    cln.add_argument('--workers', type=int, default=1, help='number of stations cleaned at the same time')
+    bf = sub.add_parser('backfill', help='fill the missing hours of a station')
+    bf.add_argument('station', choices=STATION_NAMES)
+    bf.add_argument('--start', help='first hour to check, e.g. 2023-01-01')
+    bf.add_argument('--end', help='last hour to check')
+    bf.add_argument('--hive', action='store_true', help='also download the missing messages from Hive')
+    st = sub.add_parser('status', help='cursor, queued records and export watermark of each station')
+    st.add_argument('--json', action='store_true')
+    for p in (fet, rw, cln, st):
+        p.add_argument('--stations', nargs='+', choices=STATION_NAMES, default=STATION_NAMES)
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        parser.print_help()
+        return 0
+    if args.command == 'status':
+        result = status(args.stations)
+        if args.json:
+            print(json.dumps(result, indent=1, sort_keys=True))
+            return 0
+        for name, info in result.items():
+            position = info['cursor'] or {}
+            print('%s: message %s (%s), %s records queued (%s to %s), exported up to %s' %(
+                name, position.get('packageId'), position.get('hiveRxTime'), info['queued'],
+                info['queued_first'], info['queued_last'], info['exported']))
+        return 0
+
+    # each subcommand writes its own metrics file
+    import swarm_hive
+    import swarm_metrics
+    swarm_metrics.JOB = 'swarm_%s' %(args.command)
+    try:
+        if args.command == 'fetch':
+            fetch(login_params(), args.stations)
+        elif args.command == 'raw':
+            raw(connect_sql(), None if args.no_fetch else login_params(), args.stations)
+        elif args.command == 'clean' and args.workers > 1:
+            clean(None, args.stations, args.workers)
+        elif args.command == 'clean':
+            clean(connect_sql(), args.stations)
+            swarm_metrics.flush()
+        else:
+            backfill(connect_sql(), args.station, args.start, args.end, login_params() if args.hive else None)
+            swarm_metrics.flush()
+    except swarm_hive.LoginError as err:
+        print(err)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
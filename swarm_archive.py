@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# version 1.0.0
+
+# Local archive of every message downloaded from Hive, written before the
+# messages are parsed so the original payloads are never lost once they are
+# ACK'd. Each download is saved as one gzip compressed segment of json lines
+# (packageId, hiveRxTime, deviceId, station and the base64 'data' exactly as
+# received) and a small SQLite index records which stations and which
+# hiveRxTime range every segment holds. A time window of a station can then
+# be replayed through the parsers without going back to Hive:
+#
+# python swarm_archive.py replay steph6 --start 2023-07-01 --end 2023-08-01
+# python swarm_archive.py replay mountmaya --start 2023-07-13 --end 2023-07-14 --write
+
+import argparse
+import gzip
+import json
+import os
+import sqlite3
+from datetime import datetime
+
+import pandas as pd
+
+import swarm_decode
+from swarm_stations import STATIONS, StationIndex
+
+# archive kept next to the scripts
+ARCHIVE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'swarm_archive')
+
+# messages whose station is not known are still archived under this name
+UNKNOWN = 'unknown'
+
+def connect_index(archive_dir):
+    if not os.path.isdir(archive_dir):
+        os.makedirs(archive_dir)
+    index = sqlite3.connect(os.path.join(archive_dir, 'index.sqlite'))
+    index.execute('CREATE TABLE IF NOT EXISTS segments (segment TEXT, station TEXT, '
+                  'first_rx TEXT, last_rx TEXT, first_id INTEGER, last_id INTEGER, count INTEGER)')
+    index.execute('CREATE INDEX IF NOT EXISTS ix_station_rx ON segments (station, first_rx, last_rx)')
+    return index
+
+# hiveRxTime as a sortable string, e.g. '2023-07-13T18:44:33'
+def rx_time(value):
+    if value is None:
+        return ''
+    return pd.Timestamp(value).strftime('%Y-%m-%dT%H:%M:%S')
+
+# station of each message, decoded here as the caller did not route them
+def route(messages):
+    payloads = []
+    for item in messages:
+        try:
+            payloads.append(swarm_decode.decode_payload(item['data'], 'replace') if item['data'] else '')
+        except ValueError:
+            # not base64, archived as received under UNKNOWN
+            payloads.append('')
+    return dict(zip((item['packageId'] for item in messages), StationIndex().route(payloads)))
+
+# save the messages of one download as a new segment and index it.
+# 'stations' gives the station of each packageId when the messages are
+# already decoded and routed by the caller (see swarm_ingest.collect())
+def append(messages, archive_dir=ARCHIVE_DIR, stations=None):
+    if len(messages) == 0:
+        return None
+    if stations is None:
+        stations = route(messages)
+    records = []
+    for item in messages:
+        records.append({'packageId': item['packageId'],
+                        'hiveRxTime': item.get('hiveRxTime'),
+                        'deviceId': item.get('deviceId'),
+                        'station': stations.get(item['packageId']) or UNKNOWN,
+                        'data': item['data']})
+    records.sort(key=lambda r: r['packageId'])
+
+    # one folder per month, the segment is named after its first and last
+    # message so downloading the same messages again rewrites the same file
+    month = datetime.now().strftime('%Y-%m')
+    segment = os.path.join(month, 'segment-%s-%s.jsonl.gz' %(records[0]['packageId'], records[-1]['packageId']))
+    path = os.path.join(archive_dir, segment)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    # write to a temporary file first so the index never points to half a file
+    with gzip.open(path + '.tmp', 'wt') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    os.replace(path + '.tmp', path)
+
+    index = connect_index(archive_dir)
+    with index:
+        for name in sorted(set(r['station'] for r in records)):
+            sub = [r for r in records if r['station'] == name]
+            rx = sorted(rx_time(r['hiveRxTime']) for r in sub)
+            index.execute('INSERT INTO segments VALUES (?, ?, ?, ?, ?, ?, ?)',
+                          (segment, name, rx[0], rx[-1], sub[0]['packageId'], sub[-1]['packageId'], len(sub)))
+    index.close()
+    return segment
+
+# archived messages of a station received between 'start' and 'end'
+# (hiveRxTime, end excluded), oldest first. Only the segments overlapping the
+# window are opened
+def read(station, start=None, end=None, archive_dir=ARCHIVE_DIR):
+    start = rx_time(start) if start is not None else ''
+    end = rx_time(end) if end is not None else '9999'
+    index = connect_index(archive_dir)
+    segments = [row[0] for row in index.execute(
+        'SELECT DISTINCT segment FROM segments WHERE station = ? AND last_rx >= ? AND first_rx < ?',
+        (station, start, end))]
+    index.close()
+
+    messages = {}
+    for segment in segments:
+        with gzip.open(os.path.join(archive_dir, segment), 'rt') as f:
+            for line in f:
+                record = json.loads(line)
+                if record['station'] == station and start <= rx_time(record['hiveRxTime']) < end:
+                    messages[record['packageId']] = record
+    return [messages[i] for i in sorted(messages)]
+
+# parse the archived messages of a station again, and write them to its
+# 'raw' SQL database if an engine is given
+def replay(station, start=None, end=None, engine=None, archive_dir=ARCHIVE_DIR):
+    import swarm_raw
+
+    messages = read(station, start, end, archive_dir)
+    msg, ids = swarm_decode.decode_messages(messages)
+    new_row, bad = swarm_raw.parse(station, msg)
+    print('%s messages, %s records, %s malformed for %s' %(len(messages), len(new_row), len(bad), station))
+    if engine is not None and len(new_row) > 0:
+        swarm_raw.write_new_rows(new_row, STATIONS[station]['raw_table'], engine)
+    return new_row, bad
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay archived SWARM messages through the parsers')
+    sub = parser.add_subparsers(dest='command')
+    rep = sub.add_parser('replay')
+    rep.add_argument('station', choices=list(STATIONS))
+    rep.add_argument('--start', help='first hiveRxTime to replay, e.g. 2023-07-01')
+    rep.add_argument('--end', help='hiveRxTime to stop at (excluded)')
+    rep.add_argument('--write', action='store_true', help="write the records to the 'raw' SQL database")
+    rep.add_argument('--archive', default=ARCHIVE_DIR)
+    args = parser.parse_args()
+
+    if args.command != 'replay':
+        parser.print_help()
+        return
+    engine = None
+    if args.write:
+        # Establish a connection with MySQL database 'viuhydro_wx_data_v2'
+        # Server log-in details stored in config file
+        import config
+        engine = config.main_sql()
+    new_row, bad = replay(args.station, args.start, args.end, engine, args.archive)
+    if engine is None:
+        print(new_row)
+
+if __name__ == '__main__':
+    main()
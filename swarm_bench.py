@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+# version 1.0.0
+
+# Benchmark of the SWARM pipeline on synthetic Hive traffic. The generators
+# build base64 Hive json messages in the formats sent by each wx station
+# (Mt Maya lat/lon with one hourly record, S6 and S9 with two hourly slots),
+# with a share of messages out of order, sent twice or malformed. Each stage
+# is timed on its own against a local SQLite database (or any SQLAlchemy
+# url given with --url):
+#   decode    base64 to text (swarm_decode.decode_messages)
+#   filter    routing of the messages to the stations (swarm_ingest.route_messages)
+#   parse     text to numeric matrix (swarm_decode.to_matrix)
+#   datetime  datetime of each hourly slot (swarm_decode.slot_hours)
+#   unpack    one row per hourly slot, sorted (swarm_decode.slot_values)
+#   raw_write upsert to the 'raw' tables (swarm_sql.upsert)
+#   clean     raw to clean transform (swarm_clean.transform)
+#   clean_write upsert to the 'clean' tables
+# Results can be saved as a baseline and later runs checked against it, the
+# run fails (exit code 1) if a stage got slower than the threshold:
+#
+# python swarm_bench.py run --sizes 1000 100000 --save
+# python swarm_bench.py run --sizes 1000 100000 --check --threshold 1.25
+# python swarm_bench.py generate 10000 messages.json   (e.g. for swarm_fakehive.py)
+
+import argparse
+import base64
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+
+import swarm_clean
+import swarm_decode
+import swarm_ingest
+import swarm_sql
+from swarm_obs import Observations
+from swarm_stations import STATIONS, MAYA_LAT, MAYA_LON, layout_ncols
+
+# baselines kept next to the scripts
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'swarm_bench.json')
+
+STAGES = ['decode', 'filter', 'parse', 'datetime', 'unpack', 'raw_write', 'clean', 'clean_write']
+
+# tables are written under this prefix (e.g. bench_raw_steph6) so a run
+# against a real database never touches the station tables
+PREFIX = 'bench_'
+
+# a stage slower than the baseline by less than this (seconds) is noise
+MIN_DELTA = 0.005
+
+# share of the traffic sent by each station
+SHARES = {'mountmaya': 0.4, 'steph6': 0.3, 'upperrussell': 0.3}
+
+# text of the messages of a station starting at hour 'start' (hours since
+# 1970), each message holding the following slots of its layout
+def station_payloads(name, n, start, rng):
+    layout = STATIONS[name]['layout']
+    nslots = len(layout['hour_cols'])
+    hours = start + np.arange(n*nslots).reshape(n, nslots)
+    day = hours[:, 0].astype('datetime64[h]').astype('datetime64[D]')
+    # date fields as arrays once, indexing the DatetimeIndex fields in the
+    # loop would rebuild them for every message
+    ymd = pd.DatetimeIndex(day)
+    year, month, dom = ymd.year.to_numpy(), ymd.month.to_numpy(), ymd.day.to_numpy()
+    values = np.round(rng.normal(50, 20, size=(n, nslots, len(layout['columns']))), 2).astype(str)
+
+    payloads = []
+    for i in range(n):
+        date = '%d,%02d,%02d' %(year[i], month[i], dom[i])
+        if name == 'mountmaya':
+            payloads.append('%s,%s,%s,%02d,%s' %(MAYA_LAT, MAYA_LON, date, hours[i, 0] % 24, ','.join(values[i, 0])))
+        else:
+            slots = ','.join('%02dh,%s' %(hours[i, j] % 24, ','.join(values[i, j])) for j in range(nslots))
+            payloads.append('%s,%s,%s' %(STATIONS[name]['key'], date, slots))
+    return payloads
+
+# damage a share of the messages the way they are sometimes received:
+# missing values or text in a numeric field
+def malform(payloads, share, rng):
+    for i in np.flatnonzero(rng.random(len(payloads)) < share):
+        if rng.random() < 0.5:
+            payloads[i] = payloads[i].rsplit(',', 3)[0]
+        else:
+            payloads[i] = payloads[i].replace(',', ',ERR,', 1)
+    return payloads
+
+# 'n' Hive messages (newest first, as returned by Hive) shared between the
+# stations. 'shuffle' of them are moved out of order, 'duplicate' sent
+# twice and 'malformed' damaged
+def generate(n, start='2020-01-01', seed=0, shuffle=0.05, duplicate=0.01, malformed=0.005, shares=SHARES):
+    rng = np.random.default_rng(seed)
+    start = int(np.datetime64(start, 'h').astype(np.int64))
+    counts = {name: int(round(n*share)) for name, share in shares.items()}
+    payloads = []
+    position = []
+    for name, count in counts.items():
+        payloads.extend(malform(station_payloads(name, count, start, rng), malformed, rng))
+        position.append(np.arange(count)/max(count, 1))
+
+    # messages of all stations interleaved in time, then some out of order
+    order = np.argsort(np.concatenate(position), kind='stable')
+    payloads = [payloads[i] for i in order]
+    moved = np.flatnonzero(rng.random(len(payloads)) < shuffle)
+    for i, j in zip(moved, rng.permutation(moved)):
+        payloads[i], payloads[j] = payloads[j], payloads[i]
+    again = np.flatnonzero(rng.random(len(payloads)) < duplicate)
+    payloads.extend(payloads[i] for i in again)
+
+    rx = np.datetime64('2020-01-01T00:00:00') + np.arange(len(payloads))*np.timedelta64(60, 's')
+    messages = [{'packageId': i + 1,
+                 'hiveRxTime': str(rx[i]),
+                 'deviceId': 1,
+                 'data': base64.b64encode(p.encode('ascii')).decode('ascii')}
+                for i, p in enumerate(payloads)]
+    return messages[::-1]
+
+# empty copies of the 'raw' and 'clean' tables of every station
+def create_tables(engine):
+    metadata = sa.MetaData()
+    for name in STATIONS:
+        for table, columns in ((STATIONS[name]['raw_table'], STATIONS[name]['layout']['columns']),
+                               (STATIONS[name]['clean_table'], [col for col, rule in STATIONS[name]['clean']])):
+            sa.Table(PREFIX + table, metadata, sa.Column('DateTime', sa.DateTime, index=True),
+                     *[sa.Column(col, sa.Float) for col in columns])
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    swarm_sql._metadata.clear()
+
+class Timer(object):
+
+    def __init__(self):
+        self.times = dict.fromkeys(STAGES, 0.0)
+
+    def __call__(self, stage, func, *args):
+        t0 = time.perf_counter()
+        result = func(*args)
+        self.times[stage] += time.perf_counter() - t0
+        return result
+
+# run the whole pipeline once on 'messages' and time every stage
+def run_once(messages, engine):
+    timer = Timer()
+    create_tables(engine)
+    msg, ids = timer('decode', swarm_decode.decode_messages, messages)
+    routed, routed_ids = timer('filter', swarm_ingest.route_messages, msg, ids, list(STATIONS))
+
+    rows = {}
+    for name, payloads in routed.items():
+        layout = STATIONS[name]['layout']
+        values, bad = timer('parse', swarm_decode.to_matrix, payloads, layout_ncols(layout), layout['skip'])
+        hours = timer('datetime', swarm_decode.slot_hours, values, layout)
+        dt, data = timer('unpack', swarm_decode.slot_values, values, layout, hours)
+
+        new_row = Observations.from_slots(dt, data, layout['columns'])
+        timer('raw_write', swarm_sql.upsert, engine, PREFIX + STATIONS[name]['raw_table'], new_row)
+        clean, state = timer('clean', swarm_clean.transform, STATIONS[name]['clean'], new_row.to_frame())
+        timer('clean_write', swarm_sql.upsert, engine, PREFIX + STATIONS[name]['clean_table'], clean)
+        rows[name] = {'messages': len(payloads), 'records': len(new_row), 'malformed': len(bad)}
+    return timer.times, rows
+
+# best time of each stage over 'repeat' runs for each size
+def benchmark(sizes, repeat=1, url=None, seed=0):
+    tmp = tempfile.mkdtemp(prefix='swarm_bench_')
+    engine = sa.create_engine(url or 'sqlite:///' + os.path.join(tmp, 'bench.db'))
+    results = {}
+    try:
+        for n in sizes:
+            t0 = time.perf_counter()
+            messages = generate(n, seed=seed)
+            generated = time.perf_counter() - t0
+            best = None
+            for i in range(repeat):
+                times, rows = run_once(messages, engine)
+                best = times if best is None else {s: min(best[s], times[s]) for s in STAGES}
+            results[str(n)] = {'stages': best, 'total': sum(best.values()),
+                               'generate': generated, 'rows': rows}
+            print_result(n, results[str(n)])
+    finally:
+        engine.dispose()
+        shutil.rmtree(tmp, ignore_errors=True)
+    return results
+
+def print_result(n, result):
+    print('%s messages (%s records):' %(n, sum(r['records'] for r in result['rows'].values())))
+    for stage in STAGES:
+        print('  %-12s %9.4f s  %12.0f msg/s' %(stage, result['stages'][stage], n/max(result['stages'][stage], 1e-9)))
+    print('  %-12s %9.4f s' %('total', result['total']))
+
+# stages slower than 'threshold' times their baseline, as
+# (size, stage, baseline, now) tuples
+def regressions(results, baseline, threshold):
+    slower = []
+    for n, result in results.items():
+        if n not in baseline.get('results', {}):
+            continue
+        for stage in STAGES:
+            before = baseline['results'][n]['stages'][stage]
+            now = result['stages'][stage]
+            if now > before*threshold and now - before > MIN_DELTA:
+                slower.append((n, stage, before, now))
+    return slower
+
+def environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'sqlalchemy': sa.__version__, 'machine': platform.machine(), 'date': pd.Timestamp.now().isoformat()}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the SWARM pipeline on synthetic messages')
+    sub = parser.add_subparsers(dest='command')
+    run = sub.add_parser('run', help='time every stage of the pipeline')
+    run.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    run.add_argument('--repeat', type=int, default=3, help='keep the best of this many runs')
+    run.add_argument('--url', help='SQLAlchemy url of the database to write the %s* tables to '
+                     '(default: temporary SQLite)' %(PREFIX))
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--baseline', default=BASELINE_PATH)
+    run.add_argument('--save', action='store_true', help='save the results as the new baseline')
+    run.add_argument('--check', action='store_true', help='fail if a stage is slower than the baseline')
+    run.add_argument('--threshold', type=float, default=1.25, help='slowdown allowed by --check')
+    gen = sub.add_parser('generate', help='write synthetic Hive messages to a json file')
+    gen.add_argument('n', type=int)
+    gen.add_argument('path')
+    gen.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        with open(args.path, 'w') as f:
+            json.dump(generate(args.n, seed=args.seed), f)
+        return
+    if args.command != 'run':
+        parser.print_help()
+        return
+
+    results = benchmark(args.sizes, args.repeat, args.url, args.seed)
+    if args.check:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = regressions(results, baseline, args.threshold)
+        for n, stage, before, now in slower:
+            print('REGRESSION %s messages, %s: %.4f s -> %.4f s (x%.2f)' %(n, stage, before, now, now/before))
+        if len(slower) > 0:
+            sys.exit(1)
+        print('No stage slower than x%s the baseline' %(args.threshold))
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=1, sort_keys=True)
+        print('Baseline saved to %s' %(args.baseline))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# version 1.0.0
+
+# Binary SWARM messages. Swarm bills by the byte and a CSV value such as
+# '52.287217' or '17h' takes far more bytes than the number it holds, so a
+# datalogger can instead send its hourly records as scaled integers:
+#
+#   byte 0      0x80 | format version (a CSV message always starts with an
+#               ASCII character, below 0x80, so both can share the account)
+#   byte 1      station id, the 'binary' 'id' of its layout (swarm_stations.py)
+#   bytes 2-5   uint32 hour of the first record, in hours since 1970 on the
+#               logger clock (same clock as the date and hour of the CSV)
+#   byte 6      number N of hourly records in the message
+#   then N records of one int16 per 'raw' SQL column of the station layout,
+#   value*10**decimals (-32768 for no data). Record i is for the hour of
+#   the first record + i
+#
+# all little endian. A 192 byte message then holds 7 hourly records for Mt
+# Maya or S6 (12 columns) and 11 for S9 (8 columns). Messages are decoded in
+# bulk with numpy structured dtypes, one np.frombuffer() call per message
+# size. pack() builds the messages for the datalogger firmware test vectors:
+#
+# python swarm_binary.py encode steph6 "2024-01-05 00:00" records.csv
+# python swarm_binary.py decode steph6 <base64 payload> [<base64 payload> ...]
+
+import argparse
+import base64
+import binascii
+
+import numpy as np
+import pandas as pd
+
+from swarm_stations import STATIONS
+
+# current format version, sent in the first byte as 0x80 | VERSION
+VERSION = 1
+
+# largest message Swarm accepts (bytes)
+MAX_BYTES = 192
+
+# int16 sent for no data
+MISSING = -32768
+
+HEADER = np.dtype([('version', 'u1'), ('station', 'u1'), ('hour', '<u4'), ('nslots', 'u1')])
+
+# whether a decoded payload is a binary message
+def is_binary(raw):
+    return len(raw) > 0 and raw[0] >= 0x80
+
+# dtype of a message holding 'nslots' records of 'ncols' columns
+def message_dtype(ncols, nslots):
+    return np.dtype(HEADER.descr + [('values', '<i2', (nslots, ncols))])
+
+# number of records held by a message of 'length' bytes, None if that size
+# does not fit the layout
+def message_slots(length, ncols):
+    nslots, extra = divmod(length - HEADER.itemsize, 2*ncols)
+    if length < HEADER.itemsize or extra != 0 or nslots == 0:
+        return None
+    return nslots
+
+# why a message with this header can't be read, None if it can
+def check_header(header, station_id, nslots):
+    if header['version'] != 0x80 | VERSION:
+        return 'unknown binary format version %s' %(header['version'] & 0x7f)
+    if header['station'] != station_id:
+        return 'binary station id %s, expected %s' %(header['station'], station_id)
+    if header['nslots'] != nslots:
+        return 'header gives %s records, message holds %s' %(header['nslots'], nslots)
+    return None
+
+# decode the binary messages of a station. Messages of the same size are
+# read with a single np.frombuffer() call. Returns the datetimes (not
+# sorted) and the (records x columns) matrix of values of the good messages
+# and a list of (message, reason) for the malformed ones
+def unpack(payloads, layout):
+    spec = layout['binary']
+    ncols = len(layout['columns'])
+    scale = 10.0**np.asarray(spec['decimals'])
+    lengths = np.fromiter((len(p) for p in payloads), dtype=np.int64, count=len(payloads))
+
+    hours = []
+    data = []
+    bad = []
+    for length in np.unique(lengths):
+        group = [payloads[i] for i in np.flatnonzero(lengths == length)]
+        nslots = message_slots(int(length), ncols)
+        if nslots is None:
+            bad.extend((p, 'binary message of %s bytes does not fit the layout' %(length)) for p in group)
+            continue
+
+        rec = np.frombuffer(b''.join(group), dtype=message_dtype(ncols, nslots))
+        ok = (rec['version'] == 0x80 | VERSION) & (rec['station'] == spec['id']) & (rec['nslots'] == nslots)
+        for i in np.flatnonzero(~ok):
+            bad.append((group[i], check_header(rec[i], spec['id'], nslots)))
+        rec = rec[ok]
+
+        hours.append((rec['hour'].astype(np.int64)[:, None] + np.arange(nslots)).reshape(-1))
+        values = rec['values'].reshape(-1, ncols)
+        data.append(np.where(values == MISSING, np.nan, values/scale))
+
+    if len(hours) == 0:
+        return np.array([], dtype='datetime64[ns]'), np.empty((0, ncols)), bad
+    dt = np.concatenate(hours).astype('datetime64[h]').astype('datetime64[ns]')
+    return dt, np.vstack(data), bad
+
+# binary messages of a station for consecutive hourly records starting at
+# 'start': 'records' is a (hours x columns) array of values in the order of
+# the layout columns, NaN for no data. Records are split into messages of at
+# most 'max_bytes'
+def pack(layout, start, records, max_bytes=MAX_BYTES):
+    spec = layout['binary']
+    ncols = len(layout['columns'])
+    records = np.asarray(records, dtype=np.float64).reshape(-1, ncols)
+    per_message = min((max_bytes - HEADER.itemsize)//(2*ncols), 255)
+    if per_message < 1:
+        raise ValueError('a record of %s columns does not fit in %s bytes' %(ncols, max_bytes))
+
+    scaled = np.round(records*10.0**np.asarray(spec['decimals']))
+    missing = np.isnan(scaled)
+    if np.any(np.abs(scaled[~missing]) > 32767):
+        raise ValueError('value out of range for the decimals of the layout')
+    values = np.where(missing, MISSING, scaled).astype('<i2')
+    hour = int(np.datetime64(pd.Timestamp(start), 'h').astype(np.int64))
+
+    messages = []
+    for first in range(0, len(values), per_message):
+        block = values[first:first+per_message]
+        msg = np.zeros(1, dtype=message_dtype(ncols, len(block)))
+        msg['version'] = 0x80 | VERSION
+        msg['station'] = spec['id']
+        msg['hour'] = hour + first
+        msg['nslots'] = len(block)
+        msg['values'][0] = block
+        messages.append(msg.tobytes())
+    return messages
+
+def main():
+    parser = argparse.ArgumentParser(description='Encode or decode binary SWARM messages')
+    sub = parser.add_subparsers(dest='command')
+    enc = sub.add_parser('encode', help='binary messages of consecutive hourly records')
+    enc.add_argument('station', choices=list(STATIONS))
+    enc.add_argument('start', help='hour of the first record, e.g. "2024-01-05 00:00"')
+    enc.add_argument('records', help='csv file with one line per hourly record and a header '
+                     'naming the raw SQL columns (missing columns are sent as no data)')
+    enc.add_argument('--max-bytes', type=int, default=MAX_BYTES)
+    dec = sub.add_parser('decode', help='records held by binary messages')
+    dec.add_argument('station', choices=list(STATIONS))
+    dec.add_argument('payloads', nargs='+', help='base64 payloads, as the Hive "data" field')
+    args = parser.parse_args()
+
+    if args.command is None:
+        parser.print_help()
+        return
+    layout = STATIONS[args.station]['layout']
+    if args.command == 'encode':
+        records = pd.read_csv(args.records).reindex(columns=layout['columns'])
+        for msg in pack(layout, args.start, records.to_numpy(dtype=np.float64), args.max_bytes):
+            print('%s\t%s' %(base64.b64encode(msg).decode('ascii'), binascii.hexlify(msg).decode('ascii')))
+    else:
+        dt, data, bad = unpack([base64.b64decode(p) for p in args.payloads], layout)
+        df = pd.DataFrame(data, columns=layout['columns'])
+        df.insert(0, 'DateTime', dt)
+        print(df.sort_values('DateTime', kind='stable').to_string(index=False))
+        for payload, reason in bad:
+            print('malformed: %s (%s)' %(reason, binascii.hexlify(payload).decode('ascii')))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+# version 1.0.0
+
+# Clean stage for the wx stations connected to the SWARM satellite system:
+# reads the new records of the 'raw' SQL database of a station, converts
+# them to the 'clean' layout described in swarm_stations.py and pushes them
+# to its 'clean' SQL database for VIU-Hydromet. Every column is computed on
+# the whole batch at once and differenced columns (e.g. PP_Pipe) carry the
+# last raw value of the previous batch over in 'state'. The daily and water
+# year aggregates of the days written are then updated (see swarm_rollup.py)
+# and their water years noted for the columnar export (swarm_export.py).
+#
+# A whole clean table can also be rebuilt from its raw table, e.g. after a
+# change to the clean rules, in constant memory and resuming from the last
+# chunk written if interrupted:
+#
+# python swarm_clean.py rebuild steph6 [--restart] [--chunksize 10000]
+#
+# Several stations can be cleaned at the same time, one process per station
+# each with its own engine (see clean_stations()):
+#
+# python swarm_clean.py run --stations steph6 upperrussell --workers 2
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+from datetime import datetime
+
+import swarm_coverage
+import swarm_export
+import swarm_metrics
+import swarm_rollup
+import swarm_sql
+from swarm_stations import STATIONS
+
+# engine of a worker process of clean_stations(), created at its first job
+_engine = None
+
+# progress of the rebuilds, kept next to the scripts
+CHECKPOINT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'swarm_rebuild.json')
+
+# calculate water year (new year starts on 10.01.YYYY). If months are
+# before October, do nothing. Else add +1
+def water_year(dt):
+    dt = pd.DatetimeIndex(dt)
+    return dt.year + (dt.month >= 10)
+
+# apply the 'clean' rules of a station to a batch of raw rows sorted from
+# older to newer. 'state' holds the last raw value of each differenced
+# column from the previous batch and the updated state is returned
+def transform(rules, raw, state=None):
+    state = dict(state or {})
+    raw = raw.sort_values('DateTime').reset_index(drop=True)
+
+    # No data values will automatically be added in SQL database as 'NULL'
+    clean = pd.DataFrame({'DateTime': raw['DateTime']})
+    for col, rule in rules:
+        if 'value' in rule:
+            clean[col] = rule['value']
+            continue
+        if rule.get('derive') == 'water_year':
+            clean[col] = np.asarray(water_year(raw['DateTime']))
+            continue
+
+        x = raw[rule['raw']].astype(float).to_numpy()
+        if 'diff' in rule:
+            prev = np.concatenate([[state.get(rule['raw'], np.nan)], x[:-1]])
+            y = (x - prev)*rule['diff']
+        else:
+            y = x*rule.get('scale', 1) + rule.get('offset', 0)
+        if 'round' in rule:
+            y = np.round(y, rule['round'])
+        clean[col] = y
+
+    # remember the last raw value of the differenced columns for next batch
+    if len(raw) > 0:
+        for col, rule in rules:
+            if 'diff' in rule:
+                state[rule['raw']] = float(raw[rule['raw']].iloc[-1])
+    return clean, state
+
+# raw columns differenced by the 'clean' rules of a station
+def diff_columns(rules):
+    return sorted(set(rule['raw'] for col, rule in rules if 'diff' in rule))
+
+# state to carry into a batch starting after 'since': the last raw value of
+# each differenced column at or before that time
+def load_state(engine, name, since):
+    cols = diff_columns(STATIONS[name]['clean'])
+    if since is None or len(cols) == 0:
+        return {}
+    sql = sa.text('SELECT %s FROM %s WHERE DateTime <= :since ORDER BY DateTime DESC LIMIT 1'
+                  %(', '.join(cols), STATIONS[name]['raw_table']))
+    sql = sql.bindparams(sa.bindparam('since', type_=sa.DateTime()))
+    with engine.connect() as con:
+        row = con.execute(sql, {'since': pd.Timestamp(since).to_pydatetime()}).fetchone()
+    if row is None:
+        return {}
+    return {col: (np.nan if value is None else float(value)) for col, value in zip(cols, row)}
+
+# recompute the clean records of a station from its raw records in
+# [start, end), e.g. after raw records were added in the middle of the table.
+# Returns the number of rows written
+def clean_period(engine, name, start, end, path=swarm_coverage.COVERAGE_PATH):
+    raw = swarm_sql.read_between(engine, STATIONS[name]['raw_table'], start, end)
+    if len(raw) == 0:
+        return 0
+    state = load_state(engine, name, pd.Timestamp(start) - pd.Timedelta(seconds=1))
+    with swarm_metrics.stage('clean_transform', station=name):
+        clean, state = transform(STATIONS[name]['clean'], raw, state)
+    counts = swarm_sql.upsert(engine, STATIONS[name]['clean_table'], clean)
+    swarm_coverage.record(STATIONS[name]['clean_table'], clean['DateTime'], path)
+    swarm_rollup.record(engine, name, counts['written'])
+    swarm_export.record(name, counts['written'])
+    swarm_metrics.committed(name, STATIONS[name]['clean_table'], clean['DateTime'])
+    return counts['inserted'] + counts['updated']
+
+# check the latest record of the 'raw' and 'clean' SQL databases of a
+# station and push any raw record not yet on the clean database
+def clean_station(engine, name):
+    raw_table = STATIONS[name]['raw_table']
+    clean_table = STATIONS[name]['clean_table']
+    print('Checking for new data from satellite for %s' %(name))
+
+    # if the last row in raw matches last row in clean SQL database
+    # (i.e. no new data to write), then don't write new data
+    last_dt_sql_raw = swarm_sql.last_datetime(engine, raw_table)
+    last_dt_sql_clean = swarm_sql.last_datetime(engine, clean_table)
+    if last_dt_sql_raw is None or last_dt_sql_raw == last_dt_sql_clean:
+        print('No new data detected - check satellite transmission?')
+        swarm_metrics.flush()
+        return 0
+
+    # else if new data on raw which is not yet written to clean, write it
+    print('New satellite data detected - writing to clean database')
+    raw = swarm_sql.read_since(engine, raw_table, last_dt_sql_clean)
+    state = load_state(engine, name, last_dt_sql_clean)
+    with swarm_metrics.stage('clean_transform', station=name):
+        clean, state = transform(STATIONS[name]['clean'], raw, state)
+    counts = swarm_sql.upsert(engine, clean_table, clean)
+    swarm_coverage.record(clean_table, clean['DateTime'])
+    swarm_rollup.record(engine, name, counts['written'])
+    swarm_export.record(name, counts['written'])
+    swarm_metrics.committed(name, clean_table, clean['DateTime'])
+    swarm_metrics.flush()
+
+    # write current time for sanity check
+    current_dateTime = datetime.now()
+    print("Done at:", current_dateTime, '- refreshing in 1 hour...')
+    return counts['inserted'] + counts['updated']
+
+# run clean_station() in a worker process, returning the rows written, the
+# time taken and the error raised if any (as text, exceptions don't always
+# pickle)
+def clean_job(make_engine, name):
+    global _engine
+    t0 = time.perf_counter()
+    # each station writes its own metrics file, see swarm_metrics.flush()
+    swarm_metrics.reset()
+    swarm_metrics.JOB = '%s_%s' %(swarm_metrics.job_name(), name)
+    try:
+        if _engine is None:
+            _engine = make_engine()
+        rows = clean_station(_engine, name)
+        return {'rows': rows, 'seconds': time.perf_counter() - t0, 'error': None}
+    except Exception as err:
+        print('Clean failed for %s: %r' %(name, err))
+        return {'rows': 0, 'seconds': time.perf_counter() - t0, 'error': repr(err)}
+
+# clean several stations at the same time on a pool of 'max_workers'
+# processes (one per station by default). 'make_engine' is called once in
+# each worker, e.g. config.main_sql, as engines can't be shared between
+# processes. Returns the rows written, time taken and error of each station
+def clean_stations(make_engine, stations=None, max_workers=None):
+    if stations is None:
+        stations = list(STATIONS)
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max_workers or len(stations)) as pool:
+        futures = {name: pool.submit(clean_job, make_engine, name) for name in stations}
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as err:
+                # the worker process itself died
+                results[name] = {'rows': 0, 'seconds': None, 'error': repr(err)}
+    for name, result in results.items():
+        if result['seconds'] is not None:
+            swarm_metrics.set_value('swarm_stage_last_seconds', result['seconds'], stage='clean_station', station=name)
+        swarm_metrics.add('swarm_job_failures_total', result['error'] is not None, job='clean', station=name)
+    print('Cleaned %s stations in %.1f s' %(len(stations), time.perf_counter() - t0))
+    swarm_metrics.flush()
+    return results
+
+def load_checkpoint(path=CHECKPOINT_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_checkpoint(checkpoint, path=CHECKPOINT_PATH):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(checkpoint, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+# rebuild the 'clean' SQL database of a station from its whole 'raw' SQL
+# database. The raw table is streamed oldest first in chunks, each chunk is
+# transformed with the state left by the chunk before and written with the
+# upsert, then the last DateTime and state are saved in the checkpoint so an
+# interrupted rebuild carries on from there
+def rebuild(engine, name, chunksize=10000, restart=False, checkpoint_path=CHECKPOINT_PATH):
+    checkpoint = load_checkpoint(checkpoint_path)
+    if restart or name not in checkpoint:
+        checkpoint[name] = {'DateTime': None, 'state': {}}
+    since = checkpoint[name]['DateTime']
+    state = checkpoint[name]['state']
+    print('Rebuilding %s from %s' %(STATIONS[name]['clean_table'], since or 'the first record'))
+
+    total = {'inserted': 0, 'updated': 0, 'skipped': 0}
+    for raw in swarm_sql.stream_since(engine, STATIONS[name]['raw_table'], since, chunksize):
+        if len(raw) == 0:
+            continue
+        with swarm_metrics.stage('clean_transform', station=name):
+            clean, state = transform(STATIONS[name]['clean'], raw, state)
+        counts = swarm_sql.upsert(engine, STATIONS[name]['clean_table'], clean)
+        swarm_coverage.record(STATIONS[name]['clean_table'], clean['DateTime'])
+        swarm_rollup.record(engine, name, counts['written'])
+        swarm_export.record(name, counts['written'])
+        for key in total:
+            total[key] += counts[key]
+
+        checkpoint[name] = {'DateTime': clean['DateTime'].iloc[-1].isoformat(), 'state': state}
+        save_checkpoint(checkpoint, checkpoint_path)
+        print('%s: up to %s - %s rows written, %s updated, %s skipped' %(name, checkpoint[name]['DateTime'],
+              counts['inserted'], counts['updated'], counts['skipped']))
+    swarm_metrics.flush()
+    return total
+
+def main():
+    parser = argparse.ArgumentParser(description="Push 'raw' SQL records to the 'clean' SQL databases")
+    sub = parser.add_subparsers(dest='command')
+    run = sub.add_parser('run', help='clean the new raw records of each station')
+    run.add_argument('--stations', nargs='+', choices=list(STATIONS), default=list(STATIONS))
+    run.add_argument('--workers', type=int, default=1, help='number of stations cleaned at the same time')
+    reb = sub.add_parser('rebuild', help='rebuild a whole clean table from its raw table')
+    reb.add_argument('station', choices=list(STATIONS))
+    reb.add_argument('--chunksize', type=int, default=10000)
+    reb.add_argument('--restart', action='store_true', help='ignore the checkpoint and start from the first record')
+    args = parser.parse_args()
+
+    if args.command is None:
+        parser.print_help()
+        return
+
+    # Establish a connection with MySQL database 'viuhydro_wx_data_v2'
+    # Server log-in details stored in config file
+    import config
+    if args.command == 'run' and args.workers > 1:
+        clean_stations(config.main_sql, args.stations, args.workers)
+    elif args.command == 'run':
+        engine = config.main_sql()
+        for name in args.stations:
+            clean_station(engine, name)
+    else:
+        rebuild(config.main_sql(), args.station, args.chunksize, args.restart)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+# version 1.0.0
+
+# Coverage index of the 'raw' and 'clean' SQL databases: one bit per hourly
+# slot, set when a record with that DateTime is written. Bits are kept per
+# table and per year (366*24 bits, 1098 bytes) in a small SQLite file next
+# to the scripts and are updated on every write, so missing hours (a message
+# lost in the middle of a batch, the second slot of a Stephanie message...)
+# can be listed over years of history without scanning the SQL tables.
+# Missing raw records are then looked for in the local archive (and on Hive
+# with --hive) and the clean records are recomputed from raw:
+#
+# python swarm_coverage.py build [--stations steph6]
+# python swarm_coverage.py gaps steph6 --start 2023-01-01 [--clean]
+# python swarm_coverage.py backfill steph6 --start 2023-01-01 [--hive]
+
+import argparse
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+import swarm_sql
+from swarm_stations import STATIONS
+
+# coverage index kept next to the scripts
+COVERAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'swarm_coverage.sqlite')
+
+# bits kept per year, leap years included
+YEAR_HOURS = 366*24
+
+# messages received up to this long after a missing hour are searched for it
+MARGIN = pd.Timedelta(days=2)
+
+def connect(path=COVERAGE_PATH):
+    index = sqlite3.connect(path, timeout=60, isolation_level=None)
+    index.execute('CREATE TABLE IF NOT EXISTS coverage (tbl TEXT, year INTEGER, bits BLOB, '
+                  'PRIMARY KEY (tbl, year))')
+    index.execute('CREATE TABLE IF NOT EXISTS built (tbl TEXT PRIMARY KEY, built_at TEXT)')
+    return index
+
+# year and hour of the year of each distinct hourly slot in 'times'
+def slots(times):
+    t = pd.to_datetime(pd.Series(times)).dropna().to_numpy().astype('datetime64[h]')
+    t = np.unique(t)
+    year = t.astype('datetime64[Y]')
+    offset = (t - year.astype('datetime64[h]')).astype(np.int64)
+    return year.astype(np.int64) + 1970, offset
+
+def load_bits(index, table, year):
+    row = index.execute('SELECT bits FROM coverage WHERE tbl = ? AND year = ?', (table, int(year))).fetchone()
+    if row is None:
+        return np.zeros(YEAR_HOURS, dtype=bool)
+    return np.unpackbits(np.frombuffer(row[0], dtype=np.uint8)).astype(bool)
+
+# set the bits of the hourly slots in 'times' for 'table'
+def mark(table, times, path=COVERAGE_PATH):
+    years, offset = slots(times)
+    if len(years) == 0:
+        return 0
+    index = connect(path)
+    try:
+        # lock the file for the read-modify-write so concurrent writers
+        # (one thread per station) never lose each other's bits
+        index.execute('BEGIN IMMEDIATE')
+        for year in np.unique(years):
+            bits = load_bits(index, table, year)
+            bits[offset[years == year]] = True
+            index.execute('INSERT OR REPLACE INTO coverage VALUES (?, ?, ?)',
+                          (table, int(year), np.packbits(bits).tobytes()))
+        index.execute('COMMIT')
+    except Exception:
+        index.execute('ROLLBACK')
+        raise
+    finally:
+        index.close()
+    return len(years)
+
+# mark() called after a SQL write: the records are already committed, so a
+# failure only leaves the index out of date until the next 'build'
+def record(table, times, path=COVERAGE_PATH):
+    try:
+        return mark(table, times, path)
+    except Exception as err:
+        print('Coverage index not updated for %s: %r' %(table, err))
+        return 0
+
+# index every DateTime already on 'table', reading only that column
+def build(engine, table, path=COVERAGE_PATH, chunksize=100000):
+    index = connect(path)
+    with index:
+        index.execute('BEGIN')
+        index.execute('DELETE FROM coverage WHERE tbl = ?', (table,))
+        index.execute('DELETE FROM built WHERE tbl = ?', (table,))
+    n = 0
+    for chunk in swarm_sql.stream_since(engine, table, chunksize=chunksize, columns='DateTime'):
+        n += mark(table, chunk['DateTime'], path)
+    with index:
+        index.execute('BEGIN')
+        index.execute('INSERT INTO built VALUES (?, ?)', (table, pd.Timestamp.now().isoformat()))
+    index.close()
+    print('Coverage of %s built: %s hourly records' %(table, n))
+    return n
+
+# first and last hour indexed for 'table', None if nothing is indexed
+def extent(index, table):
+    years = [row[0] for row in index.execute('SELECT year FROM coverage WHERE tbl = ? ORDER BY year', (table,))]
+    hours = []
+    for year in years:
+        set_bits = np.flatnonzero(load_bits(index, table, year))
+        if len(set_bits) > 0:
+            hours.append(np.datetime64('%04d' %(year), 'h') + set_bits[[0, -1]])
+    if len(hours) == 0:
+        return None
+    return hours[0][0], hours[-1][1]
+
+# hourly slots from 'start' to 'end' (both included, default to the first
+# and last hour indexed) and whether each one is on 'table'
+def present(table, start=None, end=None, path=COVERAGE_PATH):
+    index = connect(path)
+    try:
+        if index.execute('SELECT 1 FROM built WHERE tbl = ?', (table,)).fetchone() is None:
+            raise ValueError('coverage of %s not built yet - run: python swarm_coverage.py build' %(table))
+        first_last = extent(index, table)
+        if first_last is None:
+            return np.array([], dtype='datetime64[h]'), np.array([], dtype=bool)
+        start = first_last[0] if start is None else np.datetime64(pd.Timestamp(start), 'h')
+        end = first_last[1] if end is None else np.datetime64(pd.Timestamp(end), 'h')
+
+        hours = np.arange(start, end + 1, dtype='datetime64[h]')
+        years, offset = slots(hours)
+        found = np.zeros(len(hours), dtype=bool)
+        for year in np.unique(years):
+            sel = years == year
+            found[sel] = load_bits(index, table, year)[offset[sel]]
+    finally:
+        index.close()
+    return hours, found
+
+# runs of missing hours on 'table' as (first, last) timestamps
+def gaps(table, start=None, end=None, path=COVERAGE_PATH):
+    hours, found = present(table, start, end, path)
+    edges = np.diff(np.concatenate([[0], (~found).astype(np.int8), [0]]))
+    first = np.flatnonzero(edges == 1)
+    last = np.flatnonzero(edges == -1) - 1
+    return [(pd.Timestamp(hours[a]), pd.Timestamp(hours[b])) for a, b in zip(first, last)]
+
+# keep the records of 'new_row' (Observations) falling in one of the gaps
+def in_gaps(new_row, holes):
+    keep = np.zeros(len(new_row), dtype=bool)
+    for first, last in holes:
+        keep |= new_row.between(first, last + pd.Timedelta(hours=1))
+    return new_row[keep]
+
+# parse the messages of a station and write the records missing from its
+# 'raw' SQL database
+def fill_raw(engine, name, payloads, holes, path=COVERAGE_PATH):
+    import swarm_decode
+    import swarm_raw
+
+    new_row, bad = swarm_raw.parse(name, payloads)
+    swarm_decode.quarantine(name, bad)
+    new_row = in_gaps(new_row, holes)
+    if len(new_row) == 0:
+        return 0
+    counts = swarm_sql.upsert(engine, STATIONS[name]['raw_table'], new_row)
+    record(STATIONS[name]['raw_table'], new_row.datetimes(), path)
+    print('%s: %s records found for %s gaps' %(name, counts['inserted'] + counts['updated'], len(holes)))
+    return counts['inserted'] + counts['updated']
+
+# recompute the clean records of the gaps from the raw records
+def fill_clean(engine, name, holes, path=COVERAGE_PATH):
+    import swarm_clean
+
+    written = 0
+    for first, last in holes:
+        written += swarm_clean.clean_period(engine, name, first, last + pd.Timedelta(hours=1), path)
+    return written
+
+# look for the records missing from the 'raw' SQL database of a station in
+# the local archive, then on Hive if 'loginParams' is given, and recompute
+# the missing 'clean' records. Returns the gaps still left on raw
+def backfill(engine, name, start=None, end=None, loginParams=None, path=COVERAGE_PATH, archive_dir=None):
+    import swarm_archive
+    import swarm_decode
+
+    if archive_dir is None:
+        archive_dir = swarm_archive.ARCHIVE_DIR
+    raw_table = STATIONS[name]['raw_table']
+    holes = gaps(raw_table, start, end, path)
+    print('%s gaps on %s' %(len(holes), raw_table))
+
+    for first, last in holes:
+        messages = swarm_archive.read(name, first, last + MARGIN, archive_dir)
+        msg, ids = swarm_decode.decode_messages(messages)
+        fill_raw(engine, name, msg, [(first, last)], path)
+
+    holes = gaps(raw_table, start, end, path)
+    if len(holes) > 0 and loginParams is not None:
+        import swarm_hive
+        import swarm_ingest
+
+        with swarm_hive.connect(loginParams) as s:
+            messages = swarm_hive.fetch_window(s, swarm_archive.rx_time(holes[0][0]),
+                                               swarm_archive.rx_time(holes[-1][1] + MARGIN))
+        swarm_archive.append(messages, archive_dir)
+        msg, ids = swarm_decode.decode_messages(messages)
+        routed, routed_ids = swarm_ingest.route_messages(msg, ids, [name])
+        fill_raw(engine, name, routed[name], holes, path)
+        holes = gaps(raw_table, start, end, path)
+
+    clean_holes = gaps(STATIONS[name]['clean_table'], start, end, path)
+    print('%s gaps on %s' %(len(clean_holes), STATIONS[name]['clean_table']))
+    fill_clean(engine, name, clean_holes, path)
+    print('%s gaps left on %s' %(len(holes), raw_table))
+    return holes
+
+def main():
+    parser = argparse.ArgumentParser(description="Find and fill the missing hours of the 'raw' and 'clean' SQL databases")
+    sub = parser.add_subparsers(dest='command')
+    bld = sub.add_parser('build', help='index the records already on SQL')
+    bld.add_argument('--stations', nargs='+', choices=list(STATIONS), default=list(STATIONS))
+    gap = sub.add_parser('gaps', help='list the missing hours of a station')
+    gap.add_argument('station', choices=list(STATIONS))
+    gap.add_argument('--clean', action='store_true', help="check the 'clean' table instead of 'raw'")
+    fill = sub.add_parser('backfill', help='fill the missing hours of a station')
+    fill.add_argument('station', choices=list(STATIONS))
+    fill.add_argument('--hive', action='store_true', help='also download the missing messages from Hive')
+    for p in (gap, fill):
+        p.add_argument('--start', help='first hour to check, e.g. 2023-01-01')
+        p.add_argument('--end', help='last hour to check')
+    args = parser.parse_args()
+
+    if args.command is None:
+        parser.print_help()
+        return
+    if args.command == 'gaps':
+        table = STATIONS[args.station]['clean_table' if args.clean else 'raw_table']
+        for first, last in gaps(table, args.start, args.end):
+            print('%s - %s (%s hours)' %(first, last, int((last - first)/pd.Timedelta(hours=1)) + 1))
+        return
+
+    # Establish a connection with MySQL database 'viuhydro_wx_data_v2'
+    # Server log-in details stored in config file
+    import config
+    engine = config.main_sql()
+    if args.command == 'build':
+        for name in args.stations:
+            build(engine, STATIONS[name]['raw_table'])
+            build(engine, STATIONS[name]['clean_table'])
+    else:
+        backfill(engine, args.station, args.start, args.end, config.main_swarm() if args.hive else None)
+
+if __name__ == '__main__':
+    main()
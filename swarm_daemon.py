@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# version 1.0.0
+
+# Long running service replacing the hourly scripts. It keeps the MySQL
+# engine (and its connection pool) and the logged-in Hive session open
+# between cycles and runs, on their own intervals:
+#   - 'ingest': download the new SWARM messages, commit their records to
+#     the local write queue (swarm_queue.py), ACK them and flush the queue
+#     to 'raw' (and 'clean' for the same hours)
+#   - 'clean:<station>': push the new 'raw' records of a station to 'clean'
+# Queue and SQL writes run in a background thread so the next download can
+# start while the previous batch is still being written. If the MySQL
+# server is down the records wait in the queue for the next flush. Stop
+# with Ctrl-C or SIGTERM, pending writes are finished and ACK'd before
+# exiting.
+#
+# e.g. python swarm_daemon.py --fetch-interval 10 --clean-interval 10
+
+import argparse
+import copy
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import swarm_clean
+import swarm_hive
+import swarm_ingest
+import swarm_metrics
+import swarm_queue
+from swarm_stations import STATIONS
+
+# default interval of each job in seconds, a single station can be given its
+# own interval with e.g. 'clean:steph6'
+INTERVALS = {'ingest': 3600, 'clean': 3600}
+
+class Daemon(object):
+
+    def __init__(self, engine, loginParams, stations=None, intervals=None,
+                 max_workers=None, cursor_path=swarm_hive.CURSOR_PATH, base_url=swarm_hive.hiveBaseURL,
+                 queue_path=swarm_queue.QUEUE_PATH):
+        self.engine = engine
+        self.loginParams = loginParams
+        self.stations = list(stations or STATIONS)
+        self.intervals = dict(INTERVALS, **(intervals or {}))
+        self.max_workers = max_workers
+        self.cursor_path = cursor_path
+        self.base_url = base_url
+        self.queue = swarm_queue.WriteQueue(queue_path)
+
+        # 'cursor' is what is committed to SQL and saved, 'view' also counts
+        # the messages still being written so they are not downloaded twice
+        self.cursor = swarm_hive.load_cursor(cursor_path)
+        self.view = copy.deepcopy(self.cursor)
+
+        self.session = None
+        self.pending = None
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.stop_event = threading.Event()
+
+        # next time each job is due, everything runs straight away
+        self.due = {'ingest': 0}
+        for name in self.stations:
+            self.due['clean:%s' %(name)] = 0
+
+    def interval(self, job):
+        return self.intervals.get(job, self.intervals[job.split(':')[0]])
+
+    # log in once and keep the JSESSIONID cookie between cycles, the session
+    # logs in again by itself if the cookie expires
+    def connect(self):
+        if self.session is None:
+            self.session = swarm_hive.connect(self.loginParams, self.base_url)
+        return self.session
+
+    # ACK the messages of the previous batch once its records are queued.
+    # Returns the stations whose writes failed, their view is back at their
+    # cursor so their messages are downloaded again
+    def finish_pending(self, wait=False):
+        if self.pending is None:
+            return []
+        future, messages, routed_ids, stations = self.pending
+        if not wait and not future.done():
+            return []
+        self.pending = None
+        results = future.result()
+        try:
+            self.cursor = swarm_ingest.finish(self.connect(), stations, self.cursor, messages,
+                                              routed_ids, results, self.cursor_path)
+        finally:
+            self.view = copy.deepcopy(self.cursor)
+        return [name for name in stations if isinstance(results[name], Exception)]
+
+    # download and route the new messages, then hand the queue writes and
+    # the flush of the queue to SQL to the writer thread. Writes are kept in
+    # order: a batch is only queued once the previous one is committed and
+    # ACK'd
+    def ingest(self):
+        messages, routed, routed_ids = swarm_ingest.collect(self.connect(), self.stations, self.view)
+        # the stations whose previous batch just failed were downloaded past
+        # it: leave them out of this batch so the next download starts again
+        # from their cursor
+        failed = self.finish_pending(wait=True)
+        stations = [name for name in self.stations if name not in failed]
+        self.view = swarm_hive.advance_cursor(copy.deepcopy(self.view), messages, stations)
+        routed = {name: routed[name] for name in stations}
+        future = self.writer.submit(swarm_ingest.dispatch, routed, self.engine, self.max_workers, self.queue)
+        self.pending = (future, messages, routed_ids, stations)
+        # also writes the records left in the queue by a previous failure
+        self.writer.submit(swarm_queue.flush, self.engine, self.queue, self.stations)
+
+    # clean jobs go through the writer thread too so they always see the
+    # raw records queued before them
+    def clean(self, name):
+        def report(future):
+            if future.exception() is not None:
+                print('Clean failed for %s: %r' %(name, future.exception()))
+        self.writer.submit(swarm_clean.clean_station, self.engine, name).add_done_callback(report)
+
+    def run_job(self, job):
+        try:
+            if job == 'ingest':
+                self.ingest()
+            else:
+                self.clean(job.split(':', 1)[1])
+        except Exception as err:
+            # start again from a fresh log in at the next cycle
+            print('%s failed: %r' %(job, err))
+            swarm_metrics.add('swarm_job_failures_total', 1, job=job.split(':')[0])
+            if self.session is not None:
+                self.session.close()
+            self.session = None
+        finally:
+            swarm_metrics.flush()
+
+    def run_forever(self):
+        try:
+            while not self.stop_event.is_set():
+                for job in sorted(self.due, key=self.due.get):
+                    if self.due[job] <= time.time() and not self.stop_event.is_set():
+                        self.run_job(job)
+                        self.due[job] = time.time() + self.interval(job)
+                try:
+                    self.finish_pending()
+                except Exception as err:
+                    print('ACK failed: %r' %(err))
+
+                # wake up at least every second to ACK finished writes
+                wait = min(self.due.values()) - time.time()
+                self.stop_event.wait(min(max(wait, 0), 1.0))
+        finally:
+            self.shutdown()
+
+    def stop(self, *args):
+        print('Stopping - finishing pending writes...')
+        self.stop_event.set()
+
+    def shutdown(self):
+        try:
+            self.finish_pending(wait=True)
+        finally:
+            self.writer.shutdown(wait=True)
+            if self.session is not None:
+                self.session.close()
+            self.engine.dispose()
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the SWARM ingest and clean stages as a service')
+    parser.add_argument('--fetch-interval', type=float, default=INTERVALS['ingest']/60,
+                        help='minutes between two downloads from Hive')
+    parser.add_argument('--clean-interval', type=float, default=INTERVALS['clean']/60,
+                        help='minutes between two clean runs of each station')
+    parser.add_argument('--stations', nargs='+', choices=list(STATIONS), default=list(STATIONS))
+    parser.add_argument('--metrics', choices=['prometheus', 'jsonl', 'none'], default=swarm_metrics.FORMAT,
+                        help='format of the metrics written to %s' %(swarm_metrics.METRICS_DIR))
+    args = parser.parse_args()
+    swarm_metrics.configure(None if args.metrics == 'none' else args.metrics)
+
+    # Establish a connection with MySQL database 'viuhydro_wx_data_v2'
+    # Server log-in details stored in config file
+    import config
+    daemon = Daemon(config.main_sql(), config.main_swarm(), args.stations,
+                    {'ingest': args.fetch_interval*60, 'clean': args.clean_interval*60})
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.run_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# version 1.0.0
+
+# Bulk decoder for the SWARM CSV messages (binary messages are decoded by
+# swarm_binary.py). The whole list of messages
+# returned by Hive is decoded from base64 in one go and the values of a
+# station are converted to a numeric matrix with a single numpy call. Only
+# when that fails (wrong number of values, text in a numeric field) are the
+# messages checked one by one, and the malformed ones are put aside in the
+# quarantine file instead of stopping the run. The same goes for a message
+# whose 'data' is not valid base64 (or not ascii text).
+
+import base64
+import os
+from datetime import datetime
+
+import numpy as np
+
+import swarm_binary
+
+# malformed messages are appended here, next to the scripts
+QUARANTINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'swarm_quarantine.txt')
+
+# quarantine name of the messages that can't be decoded, so their station
+# is not known
+UNDECODABLE = 'undecodable'
+
+# 'data' of a Hive message from base64 to ascii text, or to bytes for a
+# binary message (first byte 0x80 or above, see swarm_binary.py)
+def decode_payload(data, errors='strict'):
+    raw = base64.b64decode(data)
+    if swarm_binary.is_binary(raw):
+        return raw
+    return raw.decode('ascii', errors)
+
+# for all the items in the json returned, if there is a 'data' keypair,
+# decode it with decode_payload(). Messages are returned newest first so
+# flip them to older to newer. The 'packageId' of each message is kept
+# alongside so it can be ACK'd later. A message that can't be decoded is
+# quarantined as received and left out, it must not stop the other messages
+def decode_messages(messages, path=QUARANTINE_PATH):
+    msg = []
+    ids = []
+    bad = []
+    for item in messages:
+        if not item['data']:
+            continue
+        try:
+            msg.append(decode_payload(item['data']))
+        except ValueError as err:
+            # binascii.Error and UnicodeDecodeError are both ValueErrors
+            bad.append((item['data'], 'undecodable message %s: %s' %(item['packageId'], err)))
+            continue
+        ids.append(item['packageId'])
+    quarantine(UNDECODABLE, bad, path)
+    return msg[::-1], ids[::-1]
+
+# convert the messages of one station to a (messages x ncols) float matrix.
+# 'skip' leading text columns (e.g. the 'S6' label) are dropped and the 'h'
+# following the Stephanie hours removed. Returns the matrix of the good
+# messages and a list of (message, reason) for the malformed ones
+def to_matrix(payloads, ncols, skip=0):
+    if skip:
+        fields = [p.split(',', skip)[-1] for p in payloads]
+    else:
+        fields = payloads
+
+    # fast path: every message has the expected number of values and all of
+    # them are numbers, so parse everything at once
+    counts = np.fromiter((f.count(',') for f in fields), dtype=np.int64, count=len(fields))
+    if np.all(counts == ncols - 1):
+        tokens = ','.join(fields).replace('h', '').split(',')
+        try:
+            return np.array(tokens, dtype=np.float64).reshape(len(fields), ncols), []
+        except ValueError:
+            pass
+
+    # slow path: check every message and quarantine the ones we can't read
+    rows = []
+    bad = []
+    for payload, f, n in zip(payloads, fields, counts):
+        if n != ncols - 1:
+            bad.append((payload, 'expected %s values, got %s' %(ncols, n + 1)))
+            continue
+        try:
+            rows.append(np.array(f.replace('h', '').split(','), dtype=np.float64))
+        except ValueError as err:
+            bad.append((payload, str(err)))
+    if len(rows) == 0:
+        return np.empty((0, ncols)), bad
+    return np.vstack(rows), bad
+
+# keep a copy of the malformed messages so they can be fixed and replayed,
+# binary messages in base64 as received from Hive
+def quarantine(name, bad, path=QUARANTINE_PATH):
+    if len(bad) == 0:
+        return 0
+    print('%s malformed messages for %s - see %s' %(len(bad), name, path))
+    now = datetime.now().isoformat()
+    with open(path, 'a') as f:
+        for payload, reason in bad:
+            if isinstance(payload, bytes):
+                payload = base64.b64encode(payload).decode('ascii')
+            f.write('%s\t%s\t%s\t%s\n' %(now, name, reason, payload))
+    return len(bad)
+
+# hours since 1970 of every slot of every message, one row per message. A
+# slot whose hour is smaller than the slot before it (e.g. 23h then 00h) is
+# on the next day
+def slot_hours(values, layout):
+    hour_cols = np.asarray(layout['hour_cols'])
+    year, month, day = (values[:, c].astype(np.int64) for c in layout['date_cols'])
+    hours = values[:, hour_cols].astype(np.int64)
+
+    # midnight rollover between the slots of a message
+    rollover = np.zeros_like(hours)
+    rollover[:, 1:] = np.cumsum(np.diff(hours, axis=1) < 0, axis=1)
+
+    # days since 1970 from year/month/day, then hours since 1970 for each slot
+    months = (year - 1970)*12 + month - 1
+    days = months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) + day - 1
+    return (days[:, None] + rollover)*24 + hours
+
+# values of each slot (they follow its hour column) as one row per hourly
+# record, sorted from older to newer with their datetimes
+def slot_values(values, layout, hours):
+    hour_cols = np.asarray(layout['hour_cols'])
+    cols = hour_cols[:, None] + 1 + np.arange(len(layout['columns']))
+    data = values[:, cols].reshape(-1, len(layout['columns']))
+    dt = hours.reshape(-1)
+
+    # make sure records are sorted from older to newer dates as satellite
+    # sometimes sends multiple records at same time which are not sorted
+    order = np.argsort(dt, kind='stable')
+    return dt[order].astype('datetime64[h]').astype('datetime64[ns]'), data[order]
+
+# reshape the (messages x values) matrix of a station into one row per hourly
+# record, whatever the number of slots packed in each message. The datetime
+# of every slot is built from integer hours since 1970. Returns the sorted
+# datetimes and a (records x columns) matrix of values
+def unpack_slots(values, layout):
+    return slot_values(values, layout, slot_hours(values, layout))
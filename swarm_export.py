@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+# version 1.0.0
+
+# Columnar copy of the 'clean' SQL databases for analysis, so multi-year
+# reads go to local files instead of the production MySQL server. Each
+# station is kept under swarm_export/<station>/WatYr=<water year>/ as parts
+# of consecutive records, one Arrow IPC file (uncompressed, so readers can
+# memory-map it, e.g. pyarrow.feather.read_table(part, memory_map=True) or
+# pandas.read_feather) per part, or without pyarrow one directory per part
+# holding a .npy file per column (numpy.load(..., mmap_mode='r')).
+#
+# Each run only appends the clean records past the last DateTime exported
+# (the watermark kept in swarm_export/index.sqlite). Every clean write
+# notes the water years it touched in the same index (see record()), and a
+# water year written at or before the watermark (late records, clean records
+# recomputed by a backfill or a rebuild...) has its whole partition
+# rewritten from SQL. A partition with more than MAX_PARTS parts is merged
+# back into one from its own files:
+#
+# python swarm_export.py run [--stations steph6] [--rewrite]
+# python swarm_export.py status
+
+import argparse
+import os
+import shutil
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+import swarm_metrics
+import swarm_paths
+import swarm_sql
+from swarm_stations import STATIONS
+
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    # parts are written as .npy files instead
+    feather = None
+
+# export kept next to the scripts
+EXPORT_DIR = swarm_paths.EXPORT_DIR
+
+# watermarks and water years written, inside the export directory
+INDEX_NAME = swarm_paths.EXPORT_INDEX_NAME
+
+# parts of a partition before they are merged into one
+MAX_PARTS = 24
+
+# clean records read from SQL per part
+CHUNKSIZE = 100000
+
+def connect(path=EXPORT_DIR):
+    index = sqlite3.connect(os.path.join(path, INDEX_NAME), timeout=60, isolation_level=None)
+    index.execute('CREATE TABLE IF NOT EXISTS exported (station TEXT PRIMARY KEY, last INTEGER)')
+    index.execute('CREATE TABLE IF NOT EXISTS written (station TEXT, watyr INTEGER, first INTEGER)')
+    return index
+
+# last DateTime exported for station 'name', None before its first export
+def watermark(index, name):
+    row = index.execute('SELECT last FROM exported WHERE station = ?', (name,)).fetchone()
+    if row is None or row[0] is None:
+        return None
+    return pd.Timestamp(row[0])
+
+def set_watermark(index, name, last):
+    index.execute('INSERT OR REPLACE INTO exported (station, last) VALUES (?, ?)', (name, pd.Timestamp(last).value))
+
+# note the water years of 'times' (clean records of station 'name' just
+# written) for the next export. Nothing to do until the first export
+def record(name, times, path=EXPORT_DIR):
+    import swarm_clean
+
+    if not os.path.exists(os.path.join(path, INDEX_NAME)):
+        return
+    times = pd.to_datetime(pd.Series(times)).dropna()
+    if len(times) == 0:
+        return
+    try:
+        first = times.groupby(np.asarray(swarm_clean.water_year(times))).min()
+        index = connect(path)
+        try:
+            index.executemany('INSERT INTO written (station, watyr, first) VALUES (?, ?, ?)',
+                              [(name, int(wy), t.value) for wy, t in first.items()])
+        finally:
+            index.close()
+    except Exception as err:
+        # the next 'run --rewrite' brings the export back in line
+        print('Export index not updated for %s: %r' %(name, err))
+
+def partition_dir(name, wy, path=EXPORT_DIR):
+    return os.path.join(path, name, 'WatYr=%d' %(wy))
+
+# water years exported for station 'name'
+def partitions(name, path=EXPORT_DIR):
+    station_dir = os.path.join(path, name)
+    if not os.path.isdir(station_dir):
+        return []
+    return sorted(int(d.split('=')[1]) for d in os.listdir(station_dir)
+                  if d.startswith('WatYr=') and not d.endswith('.tmp'))
+
+# parts of a partition, oldest first
+def parts(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, p) for p in os.listdir(directory)
+                  if p.startswith('part-') and not p.endswith('.tmp'))
+
+# first DateTime held by a part, from its name
+def part_first(part):
+    return pd.to_datetime(os.path.basename(part).split('.')[0].split('-')[1], format='%Y%m%d%H')
+
+# clean records with fixed column types, so every part of a station has the
+# same schema whatever its values (a column of no data reads as 'object')
+def typed(clean):
+    out = pd.DataFrame({'DateTime': pd.to_datetime(clean['DateTime']).astype('datetime64[ns]')})
+    for col in clean.columns:
+        if col == 'DateTime':
+            continue
+        if col == 'WatYr':
+            out[col] = clean[col].astype(np.int64)
+        else:
+            out[col] = pd.to_numeric(clean[col], errors='coerce').astype(np.float64)
+    return out.reset_index(drop=True)
+
+# write 'clean' (sorted by DateTime) as one new part of 'directory'. The part
+# is written under a temporary name first, so readers never see half a part
+def write_part(directory, clean):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    clean = typed(clean)
+    name = 'part-%s-%s' %(clean['DateTime'].iloc[0].strftime('%Y%m%d%H'),
+                          clean['DateTime'].iloc[-1].strftime('%Y%m%d%H'))
+    if feather is not None:
+        target = os.path.join(directory, name + '.arrow')
+        feather.write_feather(clean, target + '.tmp', compression='uncompressed')
+        os.replace(target + '.tmp', target)
+        return target
+
+    target = os.path.join(directory, name)
+    tmp = target + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    for col in clean.columns:
+        np.save(os.path.join(tmp, '%s.npy' %(col)), clean[col].to_numpy())
+    with open(os.path.join(tmp, 'columns.txt'), 'w') as f:
+        f.write('\n'.join(clean.columns))
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    os.rename(tmp, target)
+    return target
+
+def remove_part(part):
+    if os.path.isdir(part):
+        shutil.rmtree(part)
+    else:
+        os.remove(part)
+
+# columns of a part, memory-mapped
+def read_part(part, columns=None):
+    if part.endswith('.arrow'):
+        if feather is None:
+            raise RuntimeError('pyarrow is needed to read %s' %(part))
+        return feather.read_table(part, columns=columns, memory_map=True).to_pandas()
+    if columns is None:
+        with open(os.path.join(part, 'columns.txt')) as f:
+            columns = f.read().split('\n')
+    return pd.DataFrame({col: np.load(os.path.join(part, '%s.npy' %(col)), mmap_mode='r') for col in columns})
+
+# replace a whole partition with 'clean'
+def write_partition(directory, clean):
+    tmp = directory + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    if len(clean) > 0:
+        write_part(tmp, clean)
+    else:
+        os.makedirs(tmp)
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.rename(tmp, directory)
+
+# merge the parts of a partition into one if it has more than 'max_parts'
+def compact(directory, max_parts=MAX_PARTS):
+    found = parts(directory)
+    if len(found) <= max_parts:
+        return False
+    clean = pd.concat([read_part(p) for p in found], ignore_index=True)
+    write_partition(directory, clean.drop_duplicates('DateTime', keep='last').sort_values('DateTime'))
+    return True
+
+# clean records of station 'name' from the export, from 'start' (included)
+# to 'end' (excluded), only 'columns' (DateTime always included) if given
+def read(name, start=None, end=None, columns=None, path=EXPORT_DIR):
+    import swarm_rollup
+
+    if columns is not None:
+        columns = ['DateTime'] + [col for col in columns if col != 'DateTime']
+    frames = []
+    for wy in partitions(name, path):
+        if start is not None and swarm_rollup.water_year_start(wy + 1) <= pd.Timestamp(start):
+            continue
+        if end is not None and swarm_rollup.water_year_start(wy) >= pd.Timestamp(end):
+            continue
+        frames.extend(read_part(p, columns) for p in parts(partition_dir(name, wy, path)))
+    if len(frames) == 0:
+        return pd.DataFrame(columns=columns or ['DateTime'])
+    clean = pd.concat(frames, ignore_index=True)
+    keep = np.ones(len(clean), dtype=bool)
+    if start is not None:
+        keep &= (clean['DateTime'] >= pd.Timestamp(start)).to_numpy()
+    if end is not None:
+        keep &= (clean['DateTime'] < pd.Timestamp(end)).to_numpy()
+    return clean[keep].reset_index(drop=True)
+
+# bring the export of station 'name' up to date with its 'clean' SQL table:
+# rewrite the water years written at or before the watermark, then append
+# the records past it, one part per water year and chunk. Returns the
+# number of records appended and the water years rewritten
+def export_station(engine, name, path=EXPORT_DIR, rewrite=False, chunksize=CHUNKSIZE):
+    import swarm_clean
+    import swarm_rollup
+
+    clean_table = STATIONS[name]['clean_table']
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    index = connect(path)
+    try:
+        if rewrite:
+            if os.path.isdir(os.path.join(path, name)):
+                shutil.rmtree(os.path.join(path, name))
+            index.execute('DELETE FROM exported WHERE station = ?', (name,))
+        last = watermark(index, name)
+
+        # water years written since the last export. Those noted during this
+        # export are left for the next one
+        top = index.execute('SELECT MAX(rowid) FROM written WHERE station = ?', (name,)).fetchone()[0] or 0
+        late = []
+        if last is not None:
+            late = [wy for wy, first in index.execute(
+                'SELECT watyr, MIN(first) FROM written WHERE station = ? AND rowid <= ? GROUP BY watyr',
+                (name, top)).fetchall() if first <= last.value]
+
+        result = {'appended': 0, 'rewritten': sorted(late)}
+        with swarm_metrics.stage('export', station=name):
+            for wy in partitions(name, path):
+                # parts past the watermark are left by an interrupted export
+                for part in parts(partition_dir(name, wy, path)):
+                    if last is None or part_first(part) > last:
+                        remove_part(part)
+
+            for wy in sorted(late):
+                end = min(swarm_rollup.water_year_start(wy + 1), last + pd.Timedelta(seconds=1))
+                clean = swarm_sql.read_between(engine, clean_table, swarm_rollup.water_year_start(wy), end)
+                write_partition(partition_dir(name, wy, path), clean)
+                print('%s: water year %s rewritten (%s records)' %(name, wy, len(clean)))
+
+            touched = set()
+            for chunk in swarm_sql.stream_since(engine, clean_table, last, chunksize):
+                if len(chunk) == 0:
+                    continue
+                chunk = chunk.sort_values('DateTime')
+                wys = np.asarray(swarm_clean.water_year(chunk['DateTime']))
+                for wy in np.unique(wys):
+                    write_part(partition_dir(name, wy, path), chunk[wys == wy])
+                    touched.add(int(wy))
+                set_watermark(index, name, chunk['DateTime'].iloc[-1])
+                result['appended'] += len(chunk)
+
+            for wy in touched:
+                compact(partition_dir(name, wy, path))
+        index.execute('DELETE FROM written WHERE station = ? AND rowid <= ?', (name, top))
+    finally:
+        index.close()
+    swarm_metrics.add('swarm_rows_total', result['appended'], table=clean_table, op='exported')
+    print('%s: %s records appended to the export' %(name, result['appended']))
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Columnar export of the 'clean' SQL databases")
+    sub = parser.add_subparsers(dest='command')
+    run = sub.add_parser('run', help='export the clean records written since the last run')
+    run.add_argument('--stations', nargs='+', choices=list(STATIONS), default=list(STATIONS))
+    run.add_argument('--rewrite', action='store_true', help='export the whole clean tables again')
+    sub.add_parser('status', help='watermark and water years exported for each station')
+    parser.add_argument('--dir', default=EXPORT_DIR)
+    args = parser.parse_args()
+
+    if args.command is None:
+        parser.print_help()
+        return
+    if args.command == 'status':
+        if not os.path.exists(os.path.join(args.dir, INDEX_NAME)):
+            print('Nothing exported to %s yet' %(args.dir))
+            return
+        index = connect(args.dir)
+        try:
+            for name in STATIONS:
+                wys = partitions(name, args.dir)
+                print('%s: exported up to %s, water years %s' %(name, watermark(index, name),
+                      ', '.join(str(wy) for wy in wys) or 'none'))
+        finally:
+            index.close()
+        return
+
+    # Establish a connection with MySQL database 'viuhydro_wx_data_v2'
+    # Server log-in details stored in config file
+    import config
+    engine = config.main_sql()
+    for name in args.stations:
+        export_station(engine, name, args.dir, args.rewrite)
+    swarm_metrics.flush()
+
+if __name__ == '__main__':
+    main()
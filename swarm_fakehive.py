@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+# version 1.0.0
+
+# Fake Hive server running in a background thread, serving the login,
+# messages and rxack endpoints used by swarm_hive.py from messages held in
+# memory. It can fail a share of the requests (503), expire the JSESSIONID
+# after a number of requests and slow every request down, so downloads,
+# retries and log ins can be tested offline, e.g.
+#
+# with FakeHive(messages, fail_rate=0.1, expire_after=5) as hive:
+#     swarm_ingest.run(engine, hive.loginParams, base_url=hive.base_url)
+#
+# or on its own, serving the messages saved in a json file:
+#
+# python swarm_fakehive.py messages.json --port 8080 --fail-rate 0.1
+
+import argparse
+import gzip
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+# one message ACK'd per request, POST /hive/api/v1/messages/rxack/<packageId>
+ACK_PATH = '/hive/api/v1/messages/rxack/'
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class Handler(BaseHTTPRequestHandler):
+    # keep-alive, every response carries a Content-Length
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=b'', content_type='application/json', headers=None):
+        if 'gzip' in self.headers.get('Accept-Encoding', '') and len(body) > 0:
+            body = gzip.compress(body)
+            headers = dict(headers or {}, **{'Content-Encoding': 'gzip'})
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def session(self):
+        for part in self.headers.get('Cookie', '').split(';'):
+            key, _, value = part.strip().partition('=')
+            if key == 'JSESSIONID':
+                return value
+        return None
+
+    def handle_request(self, method):
+        hive = self.server.hive
+        url = urlparse(self.path)
+        body = self.read_body() if method == 'POST' else b''
+        status, payload, headers = hive.serve(method, url.path, parse_qs(url.query), body, self.session())
+        if isinstance(payload, (list, dict)):
+            payload = json.dumps(payload).encode()
+        self.reply(status, payload, headers=headers)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+class FakeHive(object):
+
+    def __init__(self, messages=None, loginParams=None, host='127.0.0.1', port=0,
+                 fail_rate=0.0, expire_after=None, delay=0.0, seed=0):
+        self.messages = {}
+        self.acked = set()
+        self.loginParams = loginParams or {'username': 'user', 'password': 'pass'}
+        self.fail_rate = fail_rate
+        self.expire_after = expire_after
+        self.delay = delay
+        self.random = random.Random(seed)
+        self.sessions = {}
+        self.stats = {'login': 0, 'messages': 0, 'rxack': 0, 'failed': 0, 'expired': 0}
+        self.lock = threading.Lock()
+        self.add(messages or [])
+        self.server = Server((host, port), Handler)
+        self.server.hive = self
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%s/hive' %(host, port)
+
+    def add(self, messages):
+        with self.lock:
+            for item in messages:
+                self.messages[item['packageId']] = dict(item)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    # answer one request, returns (status, body, headers)
+    def serve(self, method, path, query, body, sid):
+        if self.delay > 0:
+            time.sleep(self.delay)
+        with self.lock:
+            if self.random.random() < self.fail_rate:
+                self.stats['failed'] += 1
+                return 503, b'', {'Retry-After': '0'}
+
+            if method == 'POST' and path == '/hive/login':
+                form = {key: value[0] for key, value in parse_qs(body.decode()).items()}
+                self.stats['login'] += 1
+                if form != self.loginParams:
+                    return 401, b'', None
+                sid = uuid.uuid4().hex
+                self.sessions[sid] = 0
+                return 200, b'', {'Set-Cookie': 'JSESSIONID=%s; Path=/hive' %(sid)}
+
+            if sid not in self.sessions:
+                return 401, b'', None
+            self.sessions[sid] += 1
+            if self.expire_after is not None and self.sessions[sid] > self.expire_after:
+                del self.sessions[sid]
+                self.stats['expired'] += 1
+                return 401, b'', None
+
+            if method == 'GET' and path == '/hive/api/v1/messages':
+                self.stats['messages'] += 1
+                return 200, self.page(query), None
+            if method == 'POST' and path.startswith(ACK_PATH):
+                packageId = path[len(ACK_PATH):]
+                if not packageId.isdigit() or int(packageId) not in self.messages:
+                    return 404, b'', None
+                self.stats['rxack'] += 1
+                self.acked.add(int(packageId))
+                return 200, {'packageId': int(packageId), 'status': 1}, None
+        return 404, b'', None
+
+    # newest messages first, 'status' 0 for the messages not ACK'd yet and 1
+    # for those already ACK'd, paged with 'count' and 'before'
+    def page(self, query):
+        count = int(query.get('count', ['1000'])[0])
+        status = int(query.get('status', ['0'])[0])
+        before = query.get('before', [None])[0]
+        ids = sorted(self.messages, reverse=True)
+        if before is not None:
+            ids = [i for i in ids if i < int(before)]
+        if status == 0:
+            ids = [i for i in ids if i not in self.acked]
+        elif status == 1:
+            ids = [i for i in ids if i in self.acked]
+        return [self.messages[i] for i in ids[:count]]
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve SWARM messages from a fake Hive server')
+    parser.add_argument('messages', help='json file holding a list of Hive messages')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='share of the requests answered with a 503')
+    parser.add_argument('--expire-after', type=int, help='requests before a JSESSIONID expires')
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds added to every request')
+    args = parser.parse_args()
+
+    with open(args.messages) as f:
+        messages = json.load(f)
+    hive = FakeHive(messages, port=args.port, fail_rate=args.fail_rate,
+                    expire_after=args.expire_after, delay=args.delay)
+    print('Serving %s messages at %s (log in with %s)' %(len(messages), hive.base_url, hive.loginParams))
+    try:
+        hive.server.serve_forever()
+    except KeyboardInterrupt:
+        hive.server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+# version 1.0.0
+
+# Helpers to log in to the SWARM Hive server, download the messages that
+# are waiting on the Bumblebee account and acknowledge (ACK) them once they
+# are safely written to SQL. Server log-in details are read from the config
+# file by the calling script and passed in as 'loginParams'.
+#
+# HiveSession keeps its connections alive between requests, times out
+# requests that hang, retries the ones that fail on the network or with a
+# 5xx/429 (exponential backoff with jitter) and logs in again when the
+# JSESSIONID cookie has expired. Message pages are parsed while they are
+# downloaded (gzip compressed) instead of loading the whole text first.
+# See swarm_fakehive.py to run all of this against a local fake server.
+
+import json
+import os
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import swarm_paths
+
+# define output of the REST request as json
+# and other parameterized values used below
+loginHeaders = {'Content-Type': 'application/x-www-form-urlencoded'}
+hdrs = {'Accept': 'application/json'}
+
+hiveBaseURL = 'https://bumblebee.hive.swarm.space/hive'
+loginURL = hiveBaseURL + '/login'
+getMessageURL = hiveBaseURL + '/api/v1/messages'
+ackMessageURL = hiveBaseURL + '/api/v1/messages/rxack'
+
+# Hive never returns more than 1000 messages per request
+PAGE_SIZE = 1000
+
+# (connect, read) timeouts in seconds of every request
+TIMEOUT = (10, 60)
+
+# a failed request is retried up to RETRIES times, waiting about
+# BACKOFF*2**attempt seconds (at most BACKOFF_MAX) between two attempts
+RETRIES = 5
+BACKOFF = 1.0
+BACKOFF_MAX = 60.0
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# last message processed for each station, kept next to the scripts
+CURSOR_PATH = swarm_paths.CURSOR_PATH
+
+class LoginError(RuntimeError):
+    pass
+
+class HiveSession(requests.Session):
+
+    # 'base_url' replaces hiveBaseURL in every request, e.g. to use a fake
+    # server. 'loginParams' are kept to log in again when the session expires
+    def __init__(self, loginParams=None, base_url=hiveBaseURL, timeout=TIMEOUT, retries=RETRIES,
+                 backoff=BACKOFF, pool_size=10):
+        super(HiveSession, self).__init__()
+        self.loginParams = loginParams
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.headers['Accept-Encoding'] = 'gzip, deflate'
+
+    def wait(self, attempt, res=None):
+        delay = min(BACKOFF_MAX, self.backoff*2**attempt)*random.uniform(0.5, 1.5)
+        retry_after = res.headers.get('Retry-After', '') if res is not None else ''
+        if retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        time.sleep(delay)
+
+    # the JSESSIONID has expired if Hive refuses the request or sends us
+    # back to the login page
+    def expired(self, url, res):
+        if url == self.base_url + '/login' or self.loginParams is None:
+            return False
+        return res.status_code in (401, 403) or (len(res.history) > 0 and res.url.rstrip('/').endswith('/login'))
+
+    def request(self, method, url, **kwargs):
+        if url.startswith(hiveBaseURL):
+            url = self.base_url + url[len(hiveBaseURL):]
+        kwargs.setdefault('timeout', self.timeout)
+        relogged = False
+        attempt = 0
+        while True:
+            res = None
+            try:
+                res = super(HiveSession, self).request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.retries:
+                    raise
+            else:
+                if self.expired(url, res) and not relogged:
+                    res.close()
+                    login(self, self.loginParams)
+                    relogged = True
+                    continue
+                if res.status_code not in RETRY_STATUS or attempt >= self.retries:
+                    return res
+                res.close()
+            self.wait(attempt, res)
+            attempt += 1
+
+# log in to get the JSESSIONID cookie, the session then manages the cookie
+# for every following request
+def login(s, loginParams):
+    res = s.post(loginURL, data=loginParams, headers=loginHeaders)
+    if res.status_code != 200:
+        raise LoginError("Invalid username or password; please use a valid username and password in loginParams.")
+    if isinstance(s, HiveSession):
+        s.loginParams = loginParams
+    return res
+
+# new logged-in session, closed again if the log in fails
+def connect(loginParams, base_url=hiveBaseURL):
+    s = HiveSession(loginParams, base_url)
+    try:
+        login(s, loginParams)
+    except Exception:
+        s.close()
+        raise
+    return s
+
+# parse the json array of a response one message at a time while it is
+# downloaded (res must be requested with stream=True)
+def iter_json_array(res, chunk_size=65536):
+    decoder = json.JSONDecoder()
+    res.encoding = res.encoding or 'utf-8'
+    buf = ''
+    opened = False
+    for chunk in res.iter_content(chunk_size=chunk_size, decode_unicode=True):
+        buf += chunk
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buf) or buf[pos] == ']':
+                break
+            if not opened:
+                if buf[pos] != '[':
+                    raise ValueError('expected a json array from %s' %(res.url))
+                opened = True
+                pos += 1
+                continue
+            try:
+                item, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # message cut at the end of this chunk, wait for the next one
+                break
+            yield item
+        buf = buf[pos:]
+    if buf.strip() not in (']', ''):
+        raise ValueError('incomplete json array from %s' %(res.url))
+
+# download every message newer than 'last_id' that has not been ACK'd yet.
+# Hive returns the newest messages first, so keep asking for the page
+# before the oldest message received until the backlog is exhausted or
+# we reach messages that were already processed
+def fetch_messages(s, last_id=None, count=PAGE_SIZE, status=0):
+    params = {'count': count, 'status': status}
+    messages = []
+    while True:
+        res = s.get(getMessageURL, headers=hdrs, params=params, stream=True)
+        res.raise_for_status()
+        page = list(iter_json_array(res))
+        new = [item for item in page if last_id is None or item['packageId'] > last_id]
+        messages.extend(new)
+        if len(page) < count or len(new) < len(page):
+            break
+        params['before'] = min(item['packageId'] for item in page)
+    return messages
+
+# download the messages received by Hive between 'start' and 'end'
+# (hiveRxTime as 'YYYY-MM-DDTHH:MM:SS', both included), by default those
+# already ACK'd, e.g. to look again for records missing from SQL
+def fetch_window(s, start, end, count=PAGE_SIZE, status=1):
+    params = {'count': count, 'status': status}
+    messages = []
+    while True:
+        res = s.get(getMessageURL, headers=hdrs, params=params, stream=True)
+        res.raise_for_status()
+        page = list(iter_json_array(res))
+        messages.extend(item for item in page if start <= item['hiveRxTime'][:19] <= end)
+        if len(page) < count or min(item['hiveRxTime'][:19] for item in page) < start:
+            break
+        params['before'] = min(item['packageId'] for item in page)
+    return messages
+
+# ACK messages so they are not sent again with status=0. Hive ACKs one
+# message per request (POST .../rxack/<packageId>), all sent over the same
+# kept-alive connection. If one fails the messages before it stay ACK'd and
+# the others are downloaded again by the next run
+def ack_messages(s, packageIds):
+    packageIds = sorted(packageIds)
+    for packageId in packageIds:
+        res = s.post('%s/%d' %(ackMessageURL, packageId), headers=hdrs)
+        res.raise_for_status()
+    return len(packageIds)
+
+# the cursor holds the 'packageId' and 'hiveRxTime' of the newest message
+# processed for each station, e.g. {'steph6': {'packageId': 1, 'hiveRxTime': '...'}}
+def load_cursor(path=CURSOR_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+# write to a temporary file first so a crash never leaves a broken cursor
+def save_cursor(cursor, path=CURSOR_PATH):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(cursor, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+# oldest position across the stations of this run, None if one of them has
+# never been processed (i.e. read the whole backlog)
+def cursor_start(cursor, stations):
+    ids = [cursor[name]['packageId'] for name in stations if name in cursor]
+    if len(ids) < len(stations):
+        return None
+    return min(ids)
+
+# move the cursor of each station that was written successfully to the
+# newest message downloaded in this run
+def advance_cursor(cursor, messages, stations):
+    if len(messages) == 0:
+        return cursor
+    newest = max(messages, key=lambda item: item['packageId'])
+    for name in stations:
+        if name not in cursor or cursor[name]['packageId'] < newest['packageId']:
+            cursor[name] = {'packageId': newest['packageId'],
+                            'hiveRxTime': newest.get('hiveRxTime')}
+    return cursor
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# version 1.0.0
+
+# This code downloads the live SWARM satellite messages once for the whole
+# Bumblebee account, decodes them once and routes every message to the wx
+# station it belongs to (Mt Maya, Steph 6, Upper Russell). Each station is
+# then parsed and pushed to its 'raw' SQL database at the same time, a
+# failure on one station does not stop the others.
+#
+# By default the parsed records are first committed to the local write
+# queue (swarm_queue.py) and the messages ACK'd, then the queue is flushed
+# to SQL: if the MySQL server is down or slow the records simply wait in the
+# queue for the next run.
+
+from concurrent.futures import ThreadPoolExecutor
+
+import swarm_archive
+import swarm_decode
+import swarm_hive
+import swarm_metrics
+import swarm_queue
+import swarm_raw
+from swarm_stations import STATIONS, StationIndex
+
+# match each message to a station using its label (first column) or its
+# lat/lon (first two columns), unless 'names' already gives the station of
+# each message. Messages from unknown stations (or stations not in
+# 'stations') are ignored, as are messages already processed for that
+# station according to 'cursor'
+def route_messages(msg, ids, stations, cursor=None, names=None):
+    if cursor is None:
+        cursor = {}
+    if names is None:
+        names = StationIndex(stations).route(msg)
+    routed = {name: [] for name in stations}
+    routed_ids = {name: [] for name in stations}
+    for payload, packageId, name in zip(msg, ids, names):
+        if name not in routed:
+            continue
+        if name in cursor and packageId <= cursor[name]['packageId']:
+            continue
+        routed[name].append(payload)
+        routed_ids[name].append(packageId)
+    return routed, routed_ids
+
+# run every station handler in its own thread and collect either the number
+# of rows written (or queued) or the error raised by that station
+def dispatch(routed, engine, max_workers=None, queue=None):
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers or max(len(routed), 1)) as pool:
+        futures = {name: pool.submit(swarm_raw.process_station, name, rows, engine, queue)
+                   for name, rows in routed.items()}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as err:
+                print('Failed to write new data for %s: %r' %(name, err))
+                results[name] = err
+    return results
+
+# download the messages newer than the cursor, decode them and find their
+# station once, keep a copy in the local archive (unless 'archive_dir' is
+# None) and route them to the stations of this run
+def collect(s, stations, cursor, archive_dir=swarm_archive.ARCHIVE_DIR):
+    with swarm_metrics.stage('fetch'):
+        messages = swarm_hive.fetch_messages(s, swarm_hive.cursor_start(cursor, stations))
+    swarm_metrics.add('swarm_messages_total', len(messages), op='fetched')
+    with swarm_metrics.stage('decode'):
+        msg, ids = swarm_decode.decode_messages(messages)
+    with swarm_metrics.stage('filter'):
+        # every station, so the archive knows the messages of the others too
+        names = StationIndex().route(msg)
+        routed, routed_ids = route_messages(msg, ids, stations, cursor, names)
+    if archive_dir is not None:
+        with swarm_metrics.stage('archive'):
+            swarm_archive.append(messages, archive_dir, dict(zip(ids, names)))
+
+    rx = {item['packageId']: item.get('hiveRxTime') for item in messages}
+    for name in stations:
+        swarm_metrics.add('swarm_messages_total', len(routed[name]), station=name, op='routed')
+        swarm_metrics.received(name, [rx[i] for i in routed_ids[name]])
+    return messages, routed, routed_ids
+
+# once the rows of a station are committed to SQL, ACK its messages and
+# move its cursor forward. A failed station keeps its messages for the next run
+def finish(s, stations, cursor, messages, routed_ids, results, cursor_path=swarm_hive.CURSOR_PATH):
+    done = [name for name in stations if not isinstance(results[name], Exception)]
+    acked = swarm_hive.ack_messages(s, [i for name in done for i in routed_ids[name]])
+    swarm_metrics.add('swarm_messages_total', acked, op='acked')
+    cursor = swarm_hive.advance_cursor(cursor, messages, done)
+    swarm_hive.save_cursor(cursor, cursor_path)
+    return cursor
+
+# only the messages newer than the cursor are downloaded, see collect() and
+# finish(). With a 'queue_path' the messages are ACK'd once their records
+# are queued and the queue is flushed to SQL after, the results are then
+# those of the flush (with 'write' False the records stay queued and
+# 'engine' is not used). Without, records are written straight to SQL
+def run(engine, loginParams, stations=None, max_workers=None, cursor_path=swarm_hive.CURSOR_PATH,
+        base_url=swarm_hive.hiveBaseURL, queue_path=swarm_queue.QUEUE_PATH, write=True):
+    if stations is None:
+        stations = list(STATIONS)
+    cursor = swarm_hive.load_cursor(cursor_path)
+    queue = swarm_queue.WriteQueue(queue_path) if queue_path is not None else None
+
+    with swarm_hive.connect(loginParams, base_url) as s:
+        messages, routed, routed_ids = collect(s, stations, cursor)
+        results = dispatch(routed, engine, max_workers, queue)
+        finish(s, stations, cursor, messages, routed_ids, results, cursor_path)
+    if queue is not None and write:
+        results = swarm_queue.flush(engine, queue, stations)
+    swarm_metrics.flush()
+    return results
+
+if __name__ == '__main__':
+    # Establish a connection with MySQL database 'viuhydro_wx_data_v2'
+    # Server log-in details stored in config file
+    import config
+    engine = config.main_sql()
+    try:
+        run(engine, config.main_swarm())
+    except swarm_hive.LoginError as err:
+        print(err)
+        exit(1)
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+# version 1.0.0
+
+# Timings and counts of each stage of the SWARM pipeline (fetch, decode,
+# filter, unpack, SQL read, SQL write, clean transform) collected in memory
+# by the running process and written out at the end of each run, either as
+# a Prometheus textfile (for node_exporter's textfile collector) or as one
+# json line per run. Files are named after the running script, e.g.
+# swarm_metrics/Stephanie_wx_sql_satellite_raw.prom, so the scripts never
+# overwrite each other's metrics.
+#
+# Besides the stage durations and row/message counts, the latency of the
+# data is kept for each station: from the DateTime of its newest record to
+# its hiveRxTime (transmission) and to the time it was committed to SQL.
+# The timestamp of the newest record of each station is exported too, so a
+# stalled station can be alerted on, e.g. time() - swarm_last_record_timestamp_seconds > 3*3600
+#
+# A single run can be profiled with cProfile:
+#
+# python swarm_metrics.py profile [--out run.pstats] Stephanie_wx_sql_satellite_raw.py
+
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import runpy
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+
+# metrics kept next to the scripts
+METRICS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'swarm_metrics')
+
+# 'prometheus', 'jsonl' or None to not write anything, see configure()
+FORMAT = 'prometheus'
+
+# name of the metrics file, the running script by default (see job_name())
+JOB = None
+
+HELP = {
+    'swarm_stage_seconds_total': 'Time spent in each stage of the pipeline',
+    'swarm_stage_runs_total': 'Number of times each stage ran',
+    'swarm_stage_last_seconds': 'Duration of the last run of each stage',
+    'swarm_stage_max_seconds': 'Longest run of each stage',
+    'swarm_messages_total': 'SWARM messages handled',
+    'swarm_rows_total': 'SQL rows read or written',
+    'swarm_last_rx_timestamp_seconds': 'hiveRxTime of the newest message of each station',
+    'swarm_last_record_timestamp_seconds': 'DateTime of the newest record committed for each station',
+    'swarm_transmission_latency_seconds': 'hiveRxTime minus DateTime of the newest record of each station',
+    'swarm_commit_latency_seconds': 'commit time minus DateTime of the newest record of each station',
+    'swarm_last_run_timestamp_seconds': 'time the metrics were last written',
+    'swarm_job_failures_total': 'Failed runs of each job of swarm_daemon.py',
+    'swarm_push_latency_seconds': 'Time from the receipt of the oldest pushed message of a batch to its write',
+    'swarm_qc_values_total': 'Values failing each quality control check (see swarm_qc.py)',
+    }
+
+# metric name -> {labels (sorted tuple of pairs): value}, for this process
+_values = {}
+_lock = threading.Lock()
+
+def configure(fmt=FORMAT, directory=None):
+    global FORMAT, METRICS_DIR
+    if fmt not in ('prometheus', 'jsonl', None):
+        raise ValueError('unknown metrics format %r' %(fmt))
+    FORMAT = fmt
+    if directory is not None:
+        METRICS_DIR = directory
+
+def key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+def add(name, value=1, **labels):
+    with _lock:
+        series = _values.setdefault(name, {})
+        series[key(labels)] = series.get(key(labels), 0) + value
+
+def set_value(name, value, **labels):
+    with _lock:
+        _values.setdefault(name, {})[key(labels)] = value
+
+def get(name, **labels):
+    with _lock:
+        return _values.get(name, {}).get(key(labels))
+
+def reset():
+    with _lock:
+        _values.clear()
+
+# time the block as one run of 'stage', e.g.
+# with swarm_metrics.stage('decode'): ...
+@contextmanager
+def stage(name, **labels):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - t0
+        labels['stage'] = name
+        add('swarm_stage_seconds_total', seconds, **labels)
+        add('swarm_stage_runs_total', 1, **labels)
+        set_value('swarm_stage_last_seconds', seconds, **labels)
+        with _lock:
+            series = _values.setdefault('swarm_stage_max_seconds', {})
+            series[key(labels)] = max(series.get(key(labels), 0), seconds)
+
+# seconds since 1970 of a naive timestamp
+def epoch(value):
+    return (pd.Timestamp(value) - pd.Timestamp('1970-01-01'))/pd.Timedelta(seconds=1)
+
+# newest hiveRxTime of the messages routed to a station
+def received(station, rx_times):
+    rx_times = [t for t in rx_times if t]
+    if len(rx_times) > 0:
+        set_value('swarm_last_rx_timestamp_seconds', epoch(max(rx_times)[:19]), station=station)
+
+# records of a station committed to one of its tables: keep the DateTime of
+# the newest one and how late it was received and committed. Both latencies
+# also include any offset between the station clock and UTC (hiveRxTime) or
+# local time
+def committed(station, table, datetimes):
+    if len(datetimes) == 0:
+        return
+    newest = epoch(pd.Series(datetimes).max())
+    if newest < (get('swarm_last_record_timestamp_seconds', station=station, table=table) or 0):
+        return
+    set_value('swarm_last_record_timestamp_seconds', newest, station=station, table=table)
+    set_value('swarm_commit_latency_seconds', epoch(datetime.now()) - newest, station=station, table=table)
+    last_rx = get('swarm_last_rx_timestamp_seconds', station=station)
+    if last_rx is not None:
+        set_value('swarm_transmission_latency_seconds', last_rx - newest, station=station, table=table)
+
+def prometheus_text():
+    lines = []
+    with _lock:
+        for name in sorted(_values):
+            kind = 'counter' if name.endswith('_total') else 'gauge'
+            lines.append('# HELP %s %s' %(name, HELP.get(name, name)))
+            lines.append('# TYPE %s %s' %(name, kind))
+            for labels, value in sorted(_values[name].items()):
+                text = ','.join('%s="%s"' %(k, v.replace('"', '\\"')) for k, v in labels)
+                lines.append('%s%s %r' %(name, '{%s}' %(text) if text else '', float(value)))
+    return '\n'.join(lines) + '\n'
+
+def snapshot():
+    with _lock:
+        return [{'metric': name, 'labels': dict(labels), 'value': value}
+                for name in sorted(_values) for labels, value in sorted(_values[name].items())]
+
+# name of the running script, e.g. 'Stephanie_wx_sql_satellite_raw'
+def job_name():
+    name = os.path.splitext(os.path.basename(sys.argv[0] or ''))[0]
+    return name or 'python'
+
+# write the metrics of this process. Failures are only reported, metrics
+# must never stop the pipeline
+def flush(job=None):
+    if FORMAT is None:
+        return None
+    job = job or JOB or job_name()
+    set_value('swarm_last_run_timestamp_seconds', time.time())
+    try:
+        if not os.path.isdir(METRICS_DIR):
+            os.makedirs(METRICS_DIR)
+        if FORMAT == 'prometheus':
+            # the textfile collector must never read half a file
+            path = os.path.join(METRICS_DIR, '%s.prom' %(job))
+            with open(path + '.tmp', 'w') as f:
+                f.write(prometheus_text())
+            os.replace(path + '.tmp', path)
+        else:
+            path = os.path.join(METRICS_DIR, '%s.jsonl' %(job))
+            with open(path, 'a') as f:
+                f.write(json.dumps({'time': datetime.now().isoformat(), 'job': job, 'metrics': snapshot()}) + '\n')
+    except Exception as err:
+        print('Metrics not written: %r' %(err))
+        return None
+    return path
+
+# run a script under cProfile, save the stats and print the slowest calls
+def profile(script, args, out=None, limit=30):
+    out = out or os.path.splitext(os.path.basename(script))[0] + '.pstats'
+    sys.argv = [script] + list(args)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        runpy.run_path(script, run_name='__main__')
+    finally:
+        profiler.disable()
+        profiler.dump_stats(out)
+        pstats.Stats(out).sort_stats('cumulative').print_stats(limit)
+        print('Profile saved to %s' %(out))
+
+def main():
+    parser = argparse.ArgumentParser(description='Profile a single run of a SWARM script')
+    sub = parser.add_subparsers(dest='command')
+    prof = sub.add_parser('profile', help='run a script under cProfile')
+    prof.add_argument('script')
+    prof.add_argument('args', nargs=argparse.REMAINDER)
+    prof.add_argument('--out', help='where to save the stats (default: <script>.pstats)')
+    prof.add_argument('--limit', type=int, default=30, help='number of calls printed')
+    args = parser.parse_args()
+
+    if args.command != 'profile':
+        parser.print_help()
+        return
+    sys.path.insert(0, os.path.dirname(os.path.abspath(args.script)))
+    profile(args.script, args.args, args.out, args.limit)
+
+if __name__ == '__main__':
+    main()
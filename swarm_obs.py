@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# version 1.0.0
+
+# Compact container for the hourly records of a station between parsing
+# and the SQL write: the DateTime of each record as int64 nanoseconds since
+# 1970 and the values as one float array with a contiguous column per
+# field, with no python object in between. Records are kept sorted by
+# DateTime so selecting the records after a given time (e.g. those not yet
+# on SQL) is a binary search returning a view, not a copy, and the records
+# are turned straight into the parameter batches sent to SQL.
+
+import numpy as np
+import pandas as pd
+
+class Observations(object):
+
+    # 'epoch' int64 nanoseconds (or datetime64) and 'values' a (records x
+    # columns) array, both already sorted by DateTime
+    def __init__(self, epoch, values, columns, key='DateTime'):
+        epoch = np.asarray(epoch)
+        if epoch.dtype.kind == 'M':
+            epoch = epoch.astype('datetime64[ns]').view(np.int64)
+        self.epoch = epoch.astype(np.int64, copy=False)
+        self.values = values
+        self.columns = list(columns)
+        self.key = key
+
+    # from the sorted datetimes and values returned by swarm_decode.unpack_slots()
+    @classmethod
+    def from_slots(cls, dt, data, columns, dtype=np.float64):
+        return cls(dt.astype('datetime64[ns]'), np.asfortranarray(data, dtype=dtype), columns)
+
+    # from a dataframe with a 'key' column of datetimes and numeric columns
+    @classmethod
+    def from_frame(cls, df, key='DateTime', dtype=np.float64):
+        df = df.sort_values(key, kind='stable')
+        columns = [col for col in df.columns if col != key]
+        epoch = pd.to_datetime(df[key]).to_numpy().astype('datetime64[ns]')
+        values = np.asfortranarray(df[columns].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=dtype))
+        return cls(epoch, values, columns, key)
+
+    def __len__(self):
+        return len(self.epoch)
+
+    def __repr__(self):
+        return repr(self.to_frame())
+
+    # a slice returns a view, a boolean mask or index array returns a copy
+    def __getitem__(self, rows):
+        return Observations(self.epoch[rows], self.values[rows], self.columns, self.key)
+
+    def datetimes(self):
+        return self.epoch.view('datetime64[ns]')
+
+    def column(self, name):
+        return self.values[:, self.columns.index(name)]
+
+    # records strictly after 'since' (all of them if None), as a view
+    def since(self, since=None):
+        if since is None:
+            return self
+        start = np.searchsorted(self.epoch, np.datetime64(pd.Timestamp(since), 'ns').view(np.int64), side='right')
+        return self[start:]
+
+    # records whose DateTime falls in [start, end)
+    def between(self, start, end):
+        t = np.array([np.datetime64(pd.Timestamp(start), 'ns'), np.datetime64(pd.Timestamp(end), 'ns')]).view(np.int64)
+        return (self.epoch >= t[0]) & (self.epoch < t[1])
+
+    # one record per DateTime, the last one received when sent several times
+    def unique(self):
+        if len(self) == 0:
+            return self
+        last = np.ones(len(self), dtype=bool)
+        last[:-1] = self.epoch[1:] != self.epoch[:-1]
+        if last.all():
+            return self
+        return self[last]
+
+    def to_frame(self):
+        df = pd.DataFrame(self.values, columns=self.columns)
+        df.insert(0, self.key, self.datetimes())
+        return df
+
+    # list of dicts used as SQL parameters ('NULL' for no data values), the
+    # DateTime under 'key' (e.g. '_key' to bind it in a WHERE clause)
+    def records(self, key=None):
+        key = key or self.key
+        dts = self.datetimes().astype('datetime64[us]').tolist()
+        rows = []
+        for dt, row in zip(dts, self.values.tolist()):
+            params = dict(zip(self.columns, [None if v != v else v for v in row]))
+            params[key] = dt
+            rows.append(params)
+        return rows
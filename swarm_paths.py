@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# version 1.0.0
+
+# Names of the wx stations and paths of the local files read by swarm.py
+# (cursor, write queue and export index). They are kept here, with the
+# standard library only, so 'python swarm.py status' answers without
+# loading numpy, pandas, requests or SQLAlchemy. swarm_stations.py,
+# swarm_hive.py, swarm_queue.py and swarm_export.py take their own values
+# from this module.
+
+import os
+
+# files kept next to the scripts
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# stations of swarm_stations.STATIONS, in the same order (checked there)
+STATION_NAMES = ['mountmaya', 'steph6', 'upperrussell']
+
+# newest message processed for each station, see swarm_hive.py
+CURSOR_PATH = os.path.join(HERE, 'swarm_cursor.json')
+
+# records waiting to be written to SQL, see swarm_queue.py
+QUEUE_PATH = os.path.join(HERE, 'swarm_queue.sqlite')
+
+# columnar copies of the clean tables and their index, see swarm_export.py
+EXPORT_DIR = os.path.join(HERE, 'swarm_export')
+EXPORT_INDEX_NAME = 'index.sqlite'
+EXPORT_INDEX = os.path.join(EXPORT_DIR, EXPORT_INDEX_NAME)
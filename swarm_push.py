@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+# version 1.0.0
+
+# Push receiver for the SWARM messages: instead of polling Hive every hour,
+# Hive (or any sender) POSTs the messages as they are received, in the same
+# json shape as /api/v1/messages (one message or a list of them, each with
+# its 'packageId' and base64 'data'). Messages are checked and buffered, and
+# the buffer is handed to the usual ingest path (archive, decode, routing,
+# per-station parsing and write, see swarm_ingest.py) as soon as it holds
+# 'max_batch' messages or its oldest message waited 'max_wait' seconds.
+#
+# Messages are ACK'd on Hive (when log in details are given) only once
+# written, so a batch lost by the receiver is still downloaded by the next
+# poll of swarm_ingest.py. The sender replays messages from a json file, the
+# local archive or synthetic traffic to test the receiver under load:
+#
+# The receiver writes to the production tables and its ACKs stop Hive from
+# sending a message again, so it only listens on the local machine unless a
+# token is given, which every request must then carry:
+#
+# python swarm_push.py serve --port 8081 [--max-batch 500] [--max-wait 2] [--ack]
+# python swarm_push.py serve --host 0.0.0.0 --token <secret> --ack
+# python swarm_push.py send http://localhost:8081/hive/push --synthetic 100000 --rate 2000
+# python swarm_push.py send http://localhost:8081/hive/push --archive steph6 --start 2023-07-01
+
+import argparse
+import base64
+import binascii
+import gzip
+import hmac
+import ipaddress
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import numpy as np
+import requests
+
+import swarm_archive
+import swarm_decode
+import swarm_hive
+import swarm_ingest
+import swarm_metrics
+import swarm_queue
+from swarm_stations import STATIONS, StationIndex
+
+PUSH_PATH = '/hive/push'
+
+# a batch is written once it holds this many messages...
+MAX_BATCH = 500
+
+# ...or once its oldest message waited this long (seconds)
+MAX_WAIT = 2.0
+
+# largest request body accepted (bytes)
+MAX_BODY = 16*1024*1024
+
+# messages checked and kept, or the reason they are refused
+def validate(items):
+    if isinstance(items, dict):
+        items = [items]
+    if not isinstance(items, list):
+        raise ValueError('expected a message or a list of messages')
+    messages = []
+    rejected = []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict) or not isinstance(item.get('packageId'), int):
+            rejected.append({'index': i, 'reason': 'no integer packageId'})
+            continue
+        try:
+            base64.b64decode(item.get('data') or '', validate=True)
+        except (binascii.Error, TypeError, ValueError):
+            rejected.append({'index': i, 'reason': 'data is not base64'})
+            continue
+        messages.append(item)
+    return messages, rejected
+
+# buffer of messages handed to 'handle(messages, received)' by a background
+# thread, 'received' being the time the oldest message arrived
+class Batcher(object):
+
+    def __init__(self, handle, max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+        self.handle = handle
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.items = []
+        self.first = None
+        self.stopping = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, messages):
+        with self.cond:
+            if len(self.items) == 0:
+                self.first = time.time()
+            self.items.extend(messages)
+            if len(self.items) >= self.max_batch:
+                self.cond.notify()
+
+    # next batch, None once stopped and empty
+    def take(self):
+        with self.cond:
+            while True:
+                if len(self.items) > 0:
+                    wait = self.first + self.max_wait - time.time()
+                    if len(self.items) >= self.max_batch or wait <= 0 or self.stopping:
+                        break
+                elif self.stopping:
+                    return None
+                else:
+                    wait = None
+                self.cond.wait(wait)
+            batch, self.items = self.items[:self.max_batch], self.items[self.max_batch:]
+            received, self.first = self.first, (time.time() if len(self.items) > 0 else None)
+            return batch, received
+
+    def run(self):
+        while True:
+            item = self.take()
+            if item is None:
+                return
+            try:
+                self.handle(*item)
+            except Exception as err:
+                print('Push batch of %s messages failed: %r' %(len(item[0]), err))
+
+    # write what is left and stop
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        self.thread.join()
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        receiver = self.server.receiver
+        length = int(self.headers.get('Content-Length', 0))
+        if length > MAX_BODY:
+            self.close_connection = True
+            return self.reply(413, {'error': 'body larger than %s bytes' %(MAX_BODY)})
+        body = self.rfile.read(length)
+        if self.path.split('?')[0] != receiver.path:
+            return self.reply(404, {'error': 'unknown path'})
+        if receiver.token is not None and not hmac.compare_digest(
+                self.headers.get('Authorization', '').encode('utf-8'), ('Bearer %s' %(receiver.token)).encode('utf-8')):
+            return self.reply(401, {'error': 'bad token'})
+        try:
+            if self.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            messages, rejected = validate(json.loads(body.decode('utf-8')))
+        except (ValueError, OSError) as err:
+            return self.reply(400, {'error': str(err)})
+        receiver.add(messages)
+        self.reply(202, {'accepted': len(messages), 'rejected': rejected})
+
+# whether 'host' only accepts connections from the local machine
+def is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+class Receiver(object):
+
+    # 'loginParams' to ACK the messages written on Hive. 'queue_path' and
+    # 'archive_dir' as for swarm_ingest.run(), None to not use them. Any
+    # 'host' other than the local machine needs a 'token'
+    def __init__(self, engine, stations=None, loginParams=None, base_url=swarm_hive.hiveBaseURL,
+                 host='127.0.0.1', port=8081, path=PUSH_PATH, token=None, max_batch=MAX_BATCH,
+                 max_wait=MAX_WAIT, queue_path=swarm_queue.QUEUE_PATH, archive_dir=swarm_archive.ARCHIVE_DIR):
+        if token is None and not is_loopback(host):
+            raise ValueError('refusing to listen on %r without a token, anyone reaching it could '
+                             'write rows and ACK messages' %(host))
+        self.engine = engine
+        self.stations = list(stations or STATIONS)
+        self.loginParams = loginParams
+        self.base_url = base_url
+        self.path = path
+        self.token = token
+        self.queue = swarm_queue.WriteQueue(queue_path) if queue_path is not None else None
+        self.archive_dir = archive_dir
+        self.session = None
+        self.serving = False
+        self.batcher = Batcher(self.handle, max_batch, max_wait)
+        self.server = Server((host, port), Handler)
+        self.server.receiver = self
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%s%s' %(host, port, self.path)
+
+    def add(self, messages):
+        swarm_metrics.add('swarm_messages_total', len(messages), op='pushed')
+        self.batcher.add(messages)
+
+    # write one batch through the ingest path, then ACK the messages of the
+    # stations written (or committed to the write queue, which is durable, as
+    # in swarm_ingest.run()). A station whose parsing or queueing raised is
+    # never ACK'd, the next poll downloads its messages again
+    def handle(self, messages, received):
+        # newest first, as returned by Hive
+        messages = sorted(messages, key=lambda item: item['packageId'], reverse=True)
+        with swarm_metrics.stage('push_batch'):
+            msg, ids = swarm_decode.decode_messages(messages)
+            names = StationIndex().route(msg)
+            routed, routed_ids = swarm_ingest.route_messages(msg, ids, self.stations, names=names)
+            if self.archive_dir is not None:
+                swarm_archive.append(messages, self.archive_dir, dict(zip(ids, names)))
+            results = swarm_ingest.dispatch(routed, self.engine, queue=self.queue)
+            done = [name for name in self.stations if not isinstance(results[name], Exception)]
+            if self.queue is not None:
+                # a failed flush leaves the records queued for the next one
+                swarm_queue.flush(self.engine, self.queue, self.stations)
+
+        if self.loginParams is not None:
+            if self.session is None:
+                self.session = swarm_hive.connect(self.loginParams, self.base_url)
+            acked = swarm_hive.ack_messages(self.session, [i for name in done for i in routed_ids[name]])
+            swarm_metrics.add('swarm_messages_total', acked, op='acked')
+        latency = time.time() - received
+        swarm_metrics.set_value('swarm_push_latency_seconds', latency)
+        swarm_metrics.flush()
+        print('Push batch: %s messages written %.2f s after receipt' %(len(messages), latency))
+
+    def serve_forever(self):
+        print('Receiving SWARM messages at %s' %(self.url))
+        self.serving = True
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.serving = True
+        return self
+
+    def stop(self):
+        # shutdown() waits for serve_forever() to return, so only call it
+        # when the server was started
+        if self.serving:
+            self.server.shutdown()
+            self.serving = False
+        self.server.server_close()
+        self.batcher.stop()
+        if self.session is not None:
+            self.session.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+# POST 'messages' to a receiver, 'batch' messages per request from
+# 'workers' threads, at most 'rate' messages per second if given. Returns
+# the messages sent, the time taken and the latency of the requests
+def send(url, messages, batch=100, rate=None, workers=4, token=None):
+    messages = sorted(messages, key=lambda item: item['packageId'])
+    chunks = [messages[i:i+batch] for i in range(0, len(messages), batch)]
+    headers = {'Authorization': 'Bearer %s' %(token)} if token else {}
+    local = threading.local()
+    t0 = time.time()
+
+    def post(i):
+        if rate:
+            time.sleep(max(0, t0 + i*batch/float(rate) - time.time()))
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        start = time.time()
+        res = local.session.post(url, json=chunks[i], headers=headers, timeout=60)
+        res.raise_for_status()
+        return time.time() - start, len(res.json()['rejected'])
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(post, range(len(chunks))))
+    seconds = time.time() - t0
+    latency = np.array([r[0] for r in results]) if results else np.zeros(1)
+    return {'messages': len(messages), 'rejected': sum(r[1] for r in results), 'seconds': seconds,
+            'rate': len(messages)/max(seconds, 1e-9), 'p50': np.percentile(latency, 50),
+            'p95': np.percentile(latency, 95)}
+
+def main():
+    parser = argparse.ArgumentParser(description='Receive pushed SWARM messages, or push messages to a receiver')
+    sub = parser.add_subparsers(dest='command')
+    srv = sub.add_parser('serve', help='receive messages and write them to SQL')
+    srv.add_argument('--host', default='127.0.0.1', help='any other address than the local machine needs --token')
+    srv.add_argument('--port', type=int, default=8081)
+    srv.add_argument('--path', default=PUSH_PATH)
+    srv.add_argument('--token', help='refuse requests without "Authorization: Bearer <token>"')
+    srv.add_argument('--max-batch', type=int, default=MAX_BATCH, help='messages written at once')
+    srv.add_argument('--max-wait', type=float, default=MAX_WAIT, help='seconds a message waits for its batch')
+    srv.add_argument('--stations', nargs='+', choices=list(STATIONS), default=list(STATIONS))
+    srv.add_argument('--ack', action='store_true', help='ACK the messages written on Hive')
+    snd = sub.add_parser('send', help='push messages to a receiver')
+    snd.add_argument('url')
+    src = snd.add_mutually_exclusive_group(required=True)
+    src.add_argument('--messages', help='json file holding a list of Hive messages')
+    src.add_argument('--archive', choices=list(STATIONS), help='replay the archived messages of a station')
+    src.add_argument('--synthetic', type=int, help='number of synthetic messages (see swarm_bench.py)')
+    snd.add_argument('--start', help='first hiveRxTime replayed from the archive')
+    snd.add_argument('--end', help='hiveRxTime to stop at (excluded)')
+    snd.add_argument('--batch', type=int, default=100, help='messages per request')
+    snd.add_argument('--rate', type=float, help='messages per second (default: as fast as possible)')
+    snd.add_argument('--workers', type=int, default=4)
+    snd.add_argument('--token')
+    args = parser.parse_args()
+
+    if args.command is None:
+        parser.print_help()
+        return
+    if args.command == 'send':
+        if args.messages:
+            with open(args.messages) as f:
+                messages = json.load(f)
+        elif args.archive:
+            messages = swarm_archive.read(args.archive, args.start, args.end)
+        else:
+            import swarm_bench
+            messages = swarm_bench.generate(args.synthetic)
+        stats = send(args.url, messages, args.batch, args.rate, args.workers, args.token)
+        print('%(messages)s messages (%(rejected)s rejected) in %(seconds).1f s: %(rate).0f msg/s, '
+              'request latency p50 %(p50).3f s, p95 %(p95).3f s' %(stats))
+        return
+
+    # Establish a connection with MySQL database 'viuhydro_wx_data_v2'
+    # Server log-in details stored in config file
+    if args.token is None and not is_loopback(args.host):
+        parser.error('--host %s needs --token' %(args.host))
+    import config
+    receiver = Receiver(config.main_sql(), args.stations, config.main_swarm() if args.ack else None,
+                        host=args.host, port=args.port, path=args.path, token=args.token,
+                        max_batch=args.max_batch, max_wait=args.max_wait)
+    receiver.serve_forever()
+
+if __name__ == '__main__':
+    main()
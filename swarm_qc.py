@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# version 1.0.0
+
+# Quality control of the hourly records of a station, run between parsing
+# and the write to its 'raw' SQL database. The rules of each station are
+# kept under 'qc' in swarm_stations.py:
+#   'exclude'  list of (start, end) periods known to be erroneous, end
+#              excluded. Every value in them is set to no data
+#   'fields'   checks of each 'raw' SQL column:
+#                'min', 'max'   physical range
+#                'rate'         largest change allowed per hour
+#                'stuck'        number of consecutive hourly records with
+#                               the very same value that means a stuck sensor
+#   'action'   'null' to set the values failing a check to no data (written
+#              to SQL as 'NULL'), 'flag' to only count and report them
+#              (excluded values are set to no data either way)
+# Rows are never dropped. Exclusion periods are merged and sorted once, then
+# found with a binary search, so a batch of n records costs O(n log m) for m
+# periods and every check is a vectorized pass over one column.
+#
+# An hourly run only brings one or two new records per station, so the
+# rate and stuck checks carry on from the batch before: the last value
+# received for each column (before it is set to no data), its hour and the
+# length of its run of equal values are kept per station in a small SQLite
+# file next to the scripts. A batch older than that state (a replay, late
+# records) is checked on its own and leaves the state unchanged.
+
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+import swarm_metrics
+from swarm_stations import STATIONS
+
+# state of the rate and stuck checks, kept next to the scripts
+STATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'swarm_qc.sqlite')
+
+# bit set in the flags of a value for each check it failed
+EXCLUDED = 1
+RANGE = 2
+RATE = 4
+STUCK = 8
+
+CHECKS = [(EXCLUDED, 'excluded'), (RANGE, 'range'), (RATE, 'rate'), (STUCK, 'stuck')]
+
+# sorted, non overlapping [start, end) periods as int64 nanoseconds
+class Exclusions(object):
+
+    def __init__(self, periods=()):
+        periods = sorted((np.datetime64(pd.Timestamp(start), 'ns').astype(np.int64),
+                          np.datetime64(pd.Timestamp(end), 'ns').astype(np.int64))
+                         for start, end in periods)
+        merged = []
+        for start, end in periods:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self.starts = np.array([p[0] for p in merged], dtype=np.int64)
+        self.ends = np.array([p[1] for p in merged], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.starts)
+
+    # whether each epoch (int64 nanoseconds) falls in one of the periods
+    def mask(self, epoch):
+        if len(self) == 0:
+            return np.zeros(len(epoch), dtype=bool)
+        i = np.searchsorted(self.starts, epoch, side='right') - 1
+        return (i >= 0) & (epoch < self.ends[np.maximum(i, 0)])
+
+# exclusions of each station, built on first use
+_exclusions = {}
+
+def exclusions(name):
+    if name not in _exclusions:
+        _exclusions[name] = Exclusions(STATIONS[name].get('qc', {}).get('exclude', []))
+    return _exclusions[name]
+
+# values outside [min, max]
+def check_range(x, rule):
+    bad = np.zeros(len(x), dtype=bool)
+    if 'min' in rule:
+        bad |= x < rule['min']
+    if 'max' in rule:
+        bad |= x > rule['max']
+    return bad
+
+# values changing by more than 'rate' per hour from the record before them
+# (the record after a spike is flagged too). 'prev' is the state of the
+# column before the batch, if any
+def check_rate(x, hours, rule, prev=None):
+    if prev is not None:
+        x = np.concatenate([[prev['value']], x])
+        hours = np.concatenate([[prev['hour']], hours])
+    bad = np.zeros(len(x), dtype=bool)
+    if len(x) > 1:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            change = np.abs(np.diff(x))/np.diff(hours)
+        bad[1:] = change > rule['rate']
+    return bad[1:] if prev is not None else bad
+
+# length of the run of equal consecutive hourly values each value belongs
+# to, the run of 'prev' (state of the column before the batch) included
+def run_lengths(x, hours, prev=None):
+    weights = np.ones(len(x))
+    if prev is not None:
+        x = np.concatenate([[prev['value']], x])
+        hours = np.concatenate([[prev['hour']], hours])
+        weights = np.concatenate([[prev['run']], weights])
+    same = np.zeros(len(x), dtype=bool)
+    same[1:] = (x[1:] == x[:-1]) & (np.diff(hours) == 1)
+    run = np.cumsum(~same)
+    length = np.bincount(run, weights)[run].astype(np.int64)
+    return length[1:] if prev is not None else length
+
+# values in a run of at least 'stuck' consecutive hourly records with the
+# same value
+def check_stuck(x, hours, rule, prev=None):
+    return run_lengths(x, hours, prev) >= rule['stuck']
+
+# state of the rate and stuck checks of station 'name': the hour, value and
+# run length of the last value received for each column
+def load_state(name, path=STATE_PATH):
+    index = sqlite3.connect(path, timeout=60)
+    try:
+        index.execute('CREATE TABLE IF NOT EXISTS state (station TEXT, col TEXT, hour REAL, value REAL, '
+                      'run INTEGER, PRIMARY KEY (station, col))')
+        rows = index.execute('SELECT col, hour, value, run FROM state WHERE station = ?', (name,)).fetchall()
+    finally:
+        index.close()
+    return {col: {'hour': hour, 'value': np.nan if value is None else value, 'run': run}
+            for col, hour, value, run in rows}
+
+def save_state(name, state, path=STATE_PATH):
+    rows = [(name, col, float(s['hour']), None if np.isnan(s['value']) else float(s['value']), int(s['run']))
+            for col, s in state.items()]
+    index = sqlite3.connect(path, timeout=60)
+    try:
+        with index:
+            index.executemany('INSERT OR REPLACE INTO state (station, col, hour, value, run) '
+                              'VALUES (?, ?, ?, ?, ?)', rows)
+    finally:
+        index.close()
+
+# flags of every value of 'obs' (swarm_obs.Observations) for the rules of
+# station 'name', one bit per failed check. 'state' (see load_state()) is
+# used for the columns it holds an older hour for and updated with the last
+# value of each checked column
+def check(name, obs, state=None):
+    qc = STATIONS[name].get('qc', {})
+    flags = np.zeros(obs.values.shape, dtype=np.uint8)
+    flags[exclusions(name).mask(obs.epoch)] |= EXCLUDED
+    if len(obs) == 0:
+        return flags
+
+    hours = obs.epoch/3.6e12
+    for col, rule in qc.get('fields', {}).items():
+        if col not in obs.columns:
+            continue
+        i = obs.columns.index(col)
+        x = obs.values[:, i]
+        prev = None
+        if state is not None and col in state and state[col]['hour'] < hours[0]:
+            prev = state[col]
+        if 'min' in rule or 'max' in rule:
+            flags[check_range(x, rule), i] |= RANGE
+        if 'rate' in rule:
+            flags[check_rate(x, hours, rule, prev), i] |= RATE
+        if 'stuck' in rule:
+            flags[check_stuck(x, hours, rule, prev), i] |= STUCK
+        if state is not None and ('rate' in rule or 'stuck' in rule) and (col not in state or state[col]['hour'] < hours[-1]):
+            state[col] = {'hour': hours[-1], 'value': x[-1], 'run': run_lengths(x, hours, prev)[-1]}
+    return flags
+
+# run the checks of station 'name' on 'obs', set the excluded values (and
+# the values failing a check if its 'action' is 'null') to no data and
+# count them. The state of the rate and stuck checks is read from and
+# saved to 'path' (None to check the batch on its own). Returns the flags of
+# every value
+def apply(name, obs, path=STATE_PATH):
+    with swarm_metrics.stage('qc', station=name):
+        state = load_state(name, path) if path is not None else None
+        flags = check(name, obs, state)
+        if state:
+            save_state(name, state, path)
+        action = STATIONS[name].get('qc', {}).get('action', 'flag')
+        remove = flags != 0 if action == 'null' else (flags & EXCLUDED) != 0
+        obs.values[remove] = np.nan
+
+    counts = []
+    for bit, label in CHECKS:
+        n = int(np.count_nonzero(flags & bit))
+        if n > 0:
+            swarm_metrics.add('swarm_qc_values_total', n, station=name, check=label)
+            counts.append('%s %s' %(n, label))
+    if len(counts) > 0:
+        print('QC %s: %s values (%s)' %(name, ', '.join(counts), 'set to NULL' if action == 'null' else 'flagged, excluded ones set to NULL'))
+    return flags
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# version 1.0.0
+
+# Local write-ahead queue between parsing and the SQL databases. The parsed
+# (and quality controlled) records of each station are committed to a small
+# SQLite file next to the scripts as soon as they are downloaded, so the
+# Hive messages can be ACK'd whatever the state of the MySQL server, and
+# the flusher drains the queue to the 'raw' SQL table of each station (and
+# recomputes the 'clean' records of the same hours) in large batches.
+#
+# The queue holds one record per (station, DateTime): a record queued again
+# replaces the one waiting. Records only leave the queue once committed to
+# SQL, and as the SQL writes are upserts keyed on DateTime, a flush
+# interrupted between the SQL commit and the removal from the queue writes
+# the same values again, never a duplicate. A station failing to flush
+# (e.g. MySQL down) keeps its records for the next flush:
+#
+# python swarm_queue.py status
+# python swarm_queue.py flush [--stations steph6] [--every 10]
+
+import argparse
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+import swarm_metrics
+import swarm_paths
+from swarm_obs import Observations
+from swarm_stations import STATIONS
+
+# queue kept next to the scripts
+QUEUE_PATH = swarm_paths.QUEUE_PATH
+
+# records written to SQL per batch
+BATCH_SIZE = 50000
+
+# clean records are recomputed over one period for queued records closer
+# than this, reading a few extra raw records is cheaper than one more query
+MERGE_GAP = pd.Timedelta(days=1)
+
+class WriteQueue(object):
+
+    def __init__(self, path=QUEUE_PATH):
+        self.path = path
+        db = self.connect()
+        try:
+            # 'id' only ever grows (AUTOINCREMENT), so a record replaced while
+            # its older version is being flushed is never removed by mistake
+            with db:
+                db.execute('CREATE TABLE IF NOT EXISTS queue (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                           'station TEXT, dt INTEGER, vals BLOB, UNIQUE (station, dt))')
+        finally:
+            db.close()
+
+    # one connection per call, so threads and processes can share the queue
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=60)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=FULL')
+        return db
+
+    # commit the records of station 'name' (swarm_obs.Observations in the
+    # order of its 'raw' SQL columns). Returns the number of records queued
+    def put(self, name, obs):
+        if len(obs) == 0:
+            return 0
+        columns = STATIONS[name]['layout']['columns']
+        if obs.columns != columns:
+            raise ValueError('records of %s must have the columns %s' %(name, columns))
+        obs = obs.unique()
+        values = np.ascontiguousarray(obs.values, dtype='<f8')
+        rows = [(name, int(dt), sqlite3.Binary(row.tobytes())) for dt, row in zip(obs.epoch, values)]
+        db = self.connect()
+        try:
+            with db:
+                db.executemany('INSERT OR REPLACE INTO queue (station, dt, vals) VALUES (?, ?, ?)', rows)
+        finally:
+            db.close()
+        return len(rows)
+
+    # the 'limit' oldest records of station 'name' as (ids, Observations)
+    def take(self, name, limit=BATCH_SIZE):
+        columns = STATIONS[name]['layout']['columns']
+        db = self.connect()
+        try:
+            rows = db.execute('SELECT id, dt, vals FROM queue WHERE station = ? ORDER BY dt LIMIT ?',
+                              (name, limit)).fetchall()
+        finally:
+            db.close()
+        ids = [row[0] for row in rows]
+        epoch = np.array([row[1] for row in rows], dtype=np.int64)
+        values = np.frombuffer(b''.join(row[2] for row in rows), dtype='<f8').reshape(len(rows), len(columns))
+        return ids, Observations(epoch, np.asfortranarray(values), columns)
+
+    # drop the records committed to SQL
+    def remove(self, ids):
+        db = self.connect()
+        try:
+            with db:
+                db.executemany('DELETE FROM queue WHERE id = ?', [(i,) for i in ids])
+        finally:
+            db.close()
+
+    # number of records waiting and oldest and newest DateTime of each station
+    def status(self):
+        db = self.connect()
+        try:
+            rows = db.execute('SELECT station, COUNT(*), MIN(dt), MAX(dt) FROM queue GROUP BY station').fetchall()
+        finally:
+            db.close()
+        return {name: {'records': n, 'first': pd.Timestamp(first), 'last': pd.Timestamp(last)}
+                for name, n, first, last in rows}
+
+# first and last DateTime of each group of records less than 'gap' apart
+def periods(obs, gap=MERGE_GAP):
+    breaks = np.flatnonzero(np.diff(obs.epoch) > gap.value)
+    first = np.concatenate([[0], breaks + 1])
+    last = np.concatenate([breaks, [len(obs) - 1]])
+    dt = obs.datetimes()
+    return [(pd.Timestamp(dt[a]), pd.Timestamp(dt[b])) for a, b in zip(first, last)]
+
+# drain the records of a station to its 'raw' SQL table, 'batch_size' at a
+# time, and recompute its 'clean' records for the same hours (and the hour
+# after each period, whose differenced columns depend on it)
+def flush_station(engine, queue, name, batch_size=BATCH_SIZE):
+    import swarm_clean
+    import swarm_raw
+
+    written = 0
+    while True:
+        ids, obs = queue.take(name, batch_size)
+        if len(ids) == 0:
+            return written
+        with swarm_metrics.stage('flush', station=name):
+            written += swarm_raw.write_new_rows(obs, STATIONS[name]['raw_table'], engine)
+            swarm_metrics.committed(name, STATIONS[name]['raw_table'], obs.datetimes())
+            for first, last in periods(obs):
+                swarm_clean.clean_period(engine, name, first, last + pd.Timedelta(hours=2))
+        queue.remove(ids)
+        swarm_metrics.add('swarm_rows_total', len(ids), table='queue', op='flushed')
+
+# flush every station with records waiting (or only 'stations'). Returns
+# the number of raw records written or the error raised for each station
+def flush(engine, queue, stations=None, batch_size=BATCH_SIZE):
+    if stations is None:
+        stations = sorted(queue.status())
+    results = {}
+    for name in stations:
+        try:
+            results[name] = flush_station(engine, queue, name, batch_size)
+        except Exception as err:
+            print('Failed to flush %s, its records stay queued: %r' %(name, err))
+            results[name] = err
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Write the queued SWARM records to the SQL databases')
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser('status', help='records waiting for each station')
+    fl = sub.add_parser('flush', help="write the queued records to the 'raw' and 'clean' SQL databases")
+    fl.add_argument('--stations', nargs='+', choices=list(STATIONS))
+    fl.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    fl.add_argument('--every', type=float, help='keep flushing every this many minutes')
+    parser.add_argument('--queue', default=QUEUE_PATH)
+    args = parser.parse_args()
+
+    if args.command is None:
+        parser.print_help()
+        return
+    queue = WriteQueue(args.queue)
+    if args.command == 'status':
+        for name, info in sorted(queue.status().items()):
+            print('%s: %s records from %s to %s' %(name, info['records'], info['first'], info['last']))
+        return
+
+    # Establish a connection with MySQL database 'viuhydro_wx_data_v2'
+    # Server log-in details stored in config file
+    import config
+    engine = config.main_sql()
+    while True:
+        flush(engine, queue, args.stations, args.batch_size)
+        swarm_metrics.flush()
+        if args.every is None:
+            break
+        time.sleep(args.every*60)
+
+if __name__ == '__main__':
+    main()
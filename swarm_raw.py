@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# version 1.0.0
+
+# Per-station parsers turning the decoded SWARM messages into the 'raw' SQL
+# layout, and the writer pushing any record not yet on the 'raw' SQL
+# database for VIU-Hydromet. Every parser returns the new rows (as
+# swarm_obs.Observations) and the list of malformed messages set aside by
+# the decoder.
+
+import numpy as np
+from datetime import datetime
+
+import swarm_binary
+import swarm_coverage
+import swarm_decode
+import swarm_metrics
+import swarm_qc
+import swarm_sql
+from swarm_obs import Observations
+from swarm_stations import STATIONS, layout_ncols
+
+# split the messages of a station into one row per hourly record following
+# the station layout (see swarm_stations.py). Binary messages are decoded
+# apart (see swarm_binary.py) and their records merged with the CSV ones
+def parse_layout(payloads, layout):
+    binary = [p for p in payloads if isinstance(p, bytes)]
+    if len(binary) > 0:
+        payloads = [p for p in payloads if not isinstance(p, bytes)]
+    values, bad = swarm_decode.to_matrix(payloads, layout_ncols(layout), skip=layout['skip'])
+    dt, data = swarm_decode.unpack_slots(values, layout)
+
+    if len(binary) > 0:
+        bin_dt, bin_data, bin_bad = swarm_binary.unpack(binary, layout)
+        dt = np.concatenate([dt, bin_dt])
+        data = np.vstack([data, bin_data])
+        order = np.argsort(dt, kind='stable')
+        dt, data = dt[order], data[order]
+        bad = bad + bin_bad
+
+    # No data values will automatically be added in SQL database as 'NULL'
+    return Observations.from_slots(dt, data, layout['columns']), bad
+
+# Mt Maya: one hourly record per message (July 13 2023 is excluded by the
+# quality control, see 'qc' in swarm_stations.py)
+def parse_maya(payloads):
+    return parse_layout(payloads, STATIONS['mountmaya']['layout'])
+
+# Steph 6: two hourly records per message
+def parse_steph6(payloads):
+    new_row, bad = parse_layout(payloads, STATIONS['steph6']['layout'])
+    new_row.values[:, new_row.columns.index('BP')] = np.nan # in kpa but needs fixing first - Sergey is on it
+    return new_row, bad
+
+# Steph 9 (Upper Russell): two hourly records per message
+def parse_steph9(payloads):
+    return parse_layout(payloads, STATIONS['upperrussell']['layout'])
+
+PARSERS = {
+    'mountmaya': parse_maya,
+    'steph6': parse_steph6,
+    'upperrussell': parse_steph9,
+    }
+
+# parse the messages of a station and run the quality control on the
+# records (see swarm_qc.py)
+def parse(name, payloads):
+    new_row, bad = PARSERS[name](payloads)
+    swarm_qc.apply(name, new_row)
+    return new_row, bad
+
+# push the new data to the 'raw' SQL database. Records already on SQL are
+# skipped (or updated if their values changed) so a message received twice
+# or out of order never creates duplicates or gaps
+def write_new_rows(new_row, table, engine):
+    counts = swarm_sql.upsert(engine, table, new_row)
+    swarm_coverage.record(table, new_row.datetimes())
+    if counts['inserted'] + counts['updated'] == 0:
+        print('No new data detected - check satellite transmission?')
+    else:
+        print('New satellite data detected - %(inserted)s rows written, %(updated)s updated, %(skipped)s skipped' %(counts))
+    return counts['inserted'] + counts['updated']
+
+# parse the messages of one station and push them to its 'raw' SQL database,
+# or only commit them to the local write queue if one is given (see
+# swarm_queue.py)
+def process_station(name, payloads, engine, queue=None):
+    print('Checking for new data from satellite for %s' %(name))
+    with swarm_metrics.stage('unpack', station=name):
+        new_row, bad = PARSERS[name](payloads)
+    swarm_qc.apply(name, new_row)
+    swarm_metrics.add('swarm_messages_total', len(bad), station=name, op='malformed')
+    swarm_decode.quarantine(name, bad)
+    if len(new_row) == 0:
+        print('No messages received for %s - check satellite transmission?' %(name))
+        return 0
+
+    if queue is not None:
+        with swarm_metrics.stage('queue', station=name):
+            queued = queue.put(name, new_row)
+        print('%s records queued for %s' %(queued, name))
+        return queued
+
+    written = write_new_rows(new_row, STATIONS[name]['raw_table'], engine)
+    swarm_metrics.committed(name, STATIONS[name]['raw_table'], new_row.datetimes())
+
+    # write current time for sanity check
+    current_dateTime = datetime.now()
+    print("Done at:", current_dateTime, '- refreshing in 1 hour...')
+    return written
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+# version 1.0.0
+
+# Daily and water year aggregates of the 'clean' SQL databases, kept in
+# their own tables (e.g. 'daily_steph6' and 'watyr_steph6', created on first
+# use) so reports and dashboards read a few rows instead of years of hourly
+# records. The aggregates of each station are listed under 'rollup' in
+# swarm_stations.py, every aggregated column also gets the number of hours
+# with data (<col>_n) and each 'sum' its water year to date total
+# (<col>_wytd) in the daily table.
+#
+# They are updated after every write to a 'clean' table, for the days of
+# the records written only: those days are aggregated again from their
+# hourly records (so late or out of order records are handled the same
+# way), then the water year to date totals and the water year row are
+# recomputed from the daily rows of their water year. A whole station can be
+# aggregated again with:
+#
+# python swarm_rollup.py rebuild [--stations steph6]
+
+import argparse
+
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+
+import swarm_metrics
+import swarm_sql
+from swarm_stations import STATIONS
+
+# stations whose rollup tables exist, for this process
+_created = set()
+
+# columns of the daily table of a station after DateTime, WatYr and Hours
+def daily_columns(rules):
+    columns = []
+    for col, funcs in rules.items():
+        columns.extend('%s_%s' %(col, func) for func in funcs)
+        columns.append('%s_n' %(col))
+        if 'sum' in funcs:
+            columns.append('%s_wytd' %(col))
+    return columns
+
+# columns of the water year table of a station after DateTime, WatYr, Days
+# and Hours
+def watyr_columns(rules):
+    return [col for col in daily_columns(rules) if not col.endswith('_wytd')]
+
+def ensure_tables(engine, name):
+    if name in _created:
+        return
+    rules = STATIONS[name]['rollup']
+    metadata = sa.MetaData()
+    sa.Table(STATIONS[name]['daily_table'], metadata,
+             sa.Column('DateTime', sa.DateTime, index=True, unique=True),
+             sa.Column('WatYr', sa.Integer), sa.Column('Hours', sa.Integer),
+             *[sa.Column(col, sa.Float) for col in daily_columns(rules)])
+    sa.Table(STATIONS[name]['watyr_table'], metadata,
+             sa.Column('DateTime', sa.DateTime, index=True, unique=True),
+             sa.Column('WatYr', sa.Integer), sa.Column('Days', sa.Integer), sa.Column('Hours', sa.Integer),
+             *[sa.Column(col, sa.Float) for col in watyr_columns(rules)])
+    metadata.create_all(engine)
+    _created.add(name)
+
+# first hour of water year 'wy' (October 1st of the year before)
+def water_year_start(wy):
+    return pd.Timestamp(int(wy) - 1, 10, 1)
+
+# runs of consecutive days as (first, last) pairs
+def day_runs(days):
+    breaks = np.flatnonzero(np.diff(days).astype(np.int64) > 1)
+    first = np.concatenate([[0], breaks + 1])
+    last = np.concatenate([breaks, [len(days) - 1]])
+    return [(pd.Timestamp(days[a]), pd.Timestamp(days[b])) for a, b in zip(first, last)]
+
+# aggregates of each day of the hourly 'clean' records (without the water
+# year to date totals)
+def daily(rules, clean):
+    import swarm_clean
+
+    day = clean['DateTime'].dt.floor('D')
+    groups = clean.groupby(day)
+    out = pd.DataFrame({'Hours': groups.size()})
+    out.index.name = 'DateTime'
+    for col, funcs in rules.items():
+        x = pd.to_numeric(clean[col], errors='coerce').groupby(day)
+        for func in funcs:
+            out['%s_%s' %(col, func)] = x.sum(min_count=1) if func == 'sum' else x.agg(func)
+        out['%s_n' %(col)] = x.count()
+    out = out.reset_index()
+    out.insert(1, 'WatYr', np.asarray(swarm_clean.water_year(out['DateTime'])))
+    return out
+
+# water year to date totals of the daily rows of one water year
+def water_year_to_date(rules, days):
+    days = days.sort_values('DateTime').reset_index(drop=True)
+    for col, funcs in rules.items():
+        if 'sum' in funcs:
+            days['%s_wytd' %(col)] = days['%s_sum' %(col)].fillna(0).cumsum()
+    return days
+
+# aggregates of a whole water year from its daily rows
+def water_year_row(rules, wy, days):
+    row = {'DateTime': water_year_start(wy), 'WatYr': int(wy), 'Days': len(days), 'Hours': days['Hours'].sum()}
+    for col, funcs in rules.items():
+        n = days['%s_n' %(col)].sum()
+        for func in funcs:
+            x = days['%s_%s' %(col, func)]
+            if func == 'sum':
+                row['%s_sum' %(col)] = x.sum(min_count=1)
+            elif func == 'min':
+                row['%s_min' %(col)] = x.min()
+            elif func == 'max':
+                row['%s_max' %(col)] = x.max()
+            else:
+                row['%s_mean' %(col)] = (x*days['%s_n' %(col)]).sum()/n if n > 0 else np.nan
+        row['%s_n' %(col)] = n
+    return pd.DataFrame([row])
+
+# aggregate again the days of 'datetimes' (clean records just written) for
+# station 'name', then their water years. Returns the number of daily rows
+# written
+def update(engine, name, datetimes):
+    rules = STATIONS[name]['rollup']
+    days = pd.to_datetime(pd.Series(datetimes)).dropna().to_numpy().astype('datetime64[D]')
+    days = np.unique(days)
+    if len(days) == 0:
+        return 0
+    ensure_tables(engine, name)
+    daily_table = STATIONS[name]['daily_table']
+
+    written = 0
+    with swarm_metrics.stage('rollup', station=name):
+        for first, last in day_runs(days):
+            clean = swarm_sql.read_between(engine, STATIONS[name]['clean_table'], first, last + pd.Timedelta(days=1))
+            new_days = daily(rules, clean)
+            for wy in np.unique(new_days['WatYr']):
+                start = water_year_start(wy)
+                days_wy = swarm_sql.read_between(engine, daily_table, start, water_year_start(wy + 1))
+                days_wy = days_wy[~days_wy['DateTime'].isin(new_days['DateTime'])]
+                days_wy = pd.concat([days_wy, new_days[new_days['WatYr'] == wy]], ignore_index=True)
+                days_wy = water_year_to_date(rules, days_wy)
+                counts = swarm_sql.upsert(engine, daily_table, days_wy)
+                swarm_sql.upsert(engine, STATIONS[name]['watyr_table'], water_year_row(rules, wy, days_wy))
+                written += counts['inserted'] + counts['updated']
+    return written
+
+# update() called after a clean write: the records are already committed,
+# so a failure only leaves the rollups out of date until the next 'rebuild'
+def record(engine, name, datetimes):
+    try:
+        return update(engine, name, datetimes)
+    except Exception as err:
+        print('Rollups not updated for %s: %r' %(name, err))
+        return 0
+
+# aggregate the whole 'clean' table of a station again, one water year at a
+# time
+def rebuild(engine, name, chunksize=100000):
+    import swarm_clean
+
+    times = [chunk['DateTime'] for chunk in swarm_sql.stream_since(
+        engine, STATIONS[name]['clean_table'], chunksize=chunksize, columns='DateTime')]
+    if len(times) == 0:
+        return 0
+    times = pd.concat(times, ignore_index=True)
+    written = 0
+    for wy in np.unique(swarm_clean.water_year(times)):
+        start = water_year_start(wy)
+        written += update(engine, name, times[(times >= start) & (times < water_year_start(wy + 1))])
+        print('%s: water year %s aggregated' %(name, wy))
+    return written
+
+def main():
+    parser = argparse.ArgumentParser(description='Daily and water year aggregates of the clean SQL databases')
+    sub = parser.add_subparsers(dest='command')
+    reb = sub.add_parser('rebuild', help='aggregate a whole clean table again')
+    reb.add_argument('--stations', nargs='+', choices=list(STATIONS), default=list(STATIONS))
+    args = parser.parse_args()
+
+    if args.command != 'rebuild':
+        parser.print_help()
+        return
+
+    # Establish a connection with MySQL database 'viuhydro_wx_data_v2'
+    # Server log-in details stored in config file
+    import config
+    engine = config.main_sql()
+    for name in args.stations:
+        rebuild(engine, name)
+
+if __name__ == '__main__':
+    main()
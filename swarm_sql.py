@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+# version 1.0.0
+
+# Helpers to query the VIU-Hydromet MySQL database without moving whole
+# tables into pandas. The latest record of a table (its watermark) is read
+# with MAX(DateTime), which only touches the DateTime index, and rows are
+# only read past a given DateTime. New rows are written with an idempotent
+# upsert keyed on DateTime so a run can safely be repeated, straight from
+# the typed arrays of swarm_obs.Observations. When DateTime is a unique key
+# two writers (the daemon, the push receiver, a queue flush...) inserting
+# the same hour at the same time end with one row, not two.
+#
+# The DateTime indexes are set up once, not by the reads and writes:
+#
+# python swarm_sql.py index [raw_steph6 ...]
+
+import argparse
+
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql, sqlite
+
+import swarm_metrics
+from swarm_obs import Observations
+
+# number of rows sent to MySQL per INSERT/UPDATE statement
+BATCH_SIZE = 1000
+
+# table definitions read from the database, see get_table()
+_metadata = sa.MetaData()
+
+# tables whose DateTime indexes have already been looked up by this
+# process, and whether DateTime is a unique key
+_indexed = {}
+
+# whether 'table' has an index starting with DateTime (or its primary key
+# does) and whether DateTime alone is a unique key
+def datetime_indexes(engine, table):
+    insp = sa.inspect(engine)
+    indexes = [idx for idx in insp.get_indexes(table) if idx['column_names'][:1] == ['DateTime']]
+    pk = insp.get_pk_constraint(table)['constrained_columns']
+    indexed = len(indexes) > 0 or pk[:1] == ['DateTime']
+    unique = pk == ['DateTime'] or any(idx['unique'] and idx['column_names'] == ['DateTime'] for idx in indexes)
+    return indexed, unique
+
+# whether DateTime is a unique key of 'table', looked up once per process.
+# Only reads the schema, a table without any DateTime index still works
+# (reads scan the table) and is reported once
+def datetime_is_unique(engine, table):
+    if table not in _indexed:
+        try:
+            indexed, unique = datetime_indexes(engine, table)
+        except sa.exc.SQLAlchemyError as err:
+            print('Warning: could not read the indexes of %s: %r' %(table, err))
+            indexed, unique = True, False
+        if not indexed:
+            print("Warning: no DateTime index on %s, reads scan the whole table "
+                  "(see 'python swarm_sql.py index')" %(table))
+        _indexed[table] = unique
+    return _indexed[table]
+
+# give 'table' a unique index on DateTime, so MAX(DateTime) and
+# 'DateTime > ...' queries don't scan the full table and upsert() can
+# resolve concurrent inserts of the same hour. If the table already holds
+# duplicate DateTimes (written before upsert()) a non-unique index is
+# created instead and rows are inserted without the unique key. Needs the
+# INDEX privilege. Returns whether DateTime is a unique key
+def create_datetime_index(engine, table):
+    indexed, unique = datetime_indexes(engine, table)
+    if not unique:
+        try:
+            with engine.begin() as con:
+                con.execute(sa.text('CREATE UNIQUE INDEX ux_%s_DateTime ON %s (DateTime)' %(table, table)))
+            unique = True
+        except sa.exc.SQLAlchemyError as err:
+            print('Warning: no unique DateTime index on %s (duplicate DateTimes?): %r' %(table, err))
+            if not indexed:
+                with engine.begin() as con:
+                    con.execute(sa.text('CREATE INDEX ix_%s_DateTime ON %s (DateTime)' %(table, table)))
+    _indexed[table] = unique
+    return unique
+
+# INSERT statement for rows not on 'tbl' when they were looked up. When
+# 'key' is a unique key a row inserted by another writer in the meantime is
+# updated instead (ON DUPLICATE KEY UPDATE on MySQL)
+def insert_statement(con, tbl, columns, key, unique):
+    dialect = con.dialect.name
+    if unique and dialect == 'mysql':
+        stmt = mysql.insert(tbl)
+        return stmt.on_duplicate_key_update({col: stmt.inserted[col] for col in columns})
+    if unique and dialect == 'sqlite':
+        stmt = sqlite.insert(tbl)
+        return stmt.on_conflict_do_update(index_elements=[key], set_={col: stmt.excluded[col] for col in columns})
+    return tbl.insert()
+
+# latest DateTime on a table, None if the table is empty
+def last_datetime(engine, table):
+    with swarm_metrics.stage('sql_read', table=table), engine.connect() as con:
+        last = con.execute(sa.text('SELECT MAX(DateTime) FROM %s' %(table))).scalar()
+    if last is None:
+        return None
+    return pd.Timestamp(last)
+
+# read the rows of 'table' more recent than 'since' (all rows if None)
+def read_since(engine, table, since=None, descending=False):
+    order = 'DESC' if descending else 'ASC'
+    params = {}
+    if since is None:
+        sql = sa.text('SELECT * FROM %s ORDER BY DateTime %s' %(table, order))
+    else:
+        sql = sa.text('SELECT * FROM %s WHERE DateTime > :since ORDER BY DateTime %s' %(table, order))
+        sql = sql.bindparams(sa.bindparam('since', type_=sa.DateTime()))
+        params = {'since': pd.Timestamp(since).to_pydatetime()}
+    with swarm_metrics.stage('sql_read', table=table):
+        rows = pd.read_sql_query(sql=sql, con=engine, params=params, parse_dates=['DateTime'])
+    swarm_metrics.add('swarm_rows_total', len(rows), table=table, op='read')
+    return rows
+
+# read the rows of 'table' from 'start' (included) to 'end' (excluded)
+def read_between(engine, table, start, end):
+    sql = sa.text('SELECT * FROM %s WHERE DateTime >= :start AND DateTime < :end ORDER BY DateTime' %(table))
+    sql = sql.bindparams(sa.bindparam('start', type_=sa.DateTime()), sa.bindparam('end', type_=sa.DateTime()))
+    with swarm_metrics.stage('sql_read', table=table):
+        rows = pd.read_sql_query(sql=sql, con=engine, parse_dates=['DateTime'],
+                                 params={'start': pd.Timestamp(start).to_pydatetime(),
+                                         'end': pd.Timestamp(end).to_pydatetime()})
+    swarm_metrics.add('swarm_rows_total', len(rows), table=table, op='read')
+    return rows
+
+# reflect the columns of 'table' once per process
+def get_table(engine, table):
+    if table not in _metadata.tables:
+        sa.Table(table, _metadata, autoload_with=engine)
+    return _metadata.tables[table]
+
+# which rows of 'batch' are already on SQL ('existing', both Observations
+# sorted by DateTime) and which of those have the same values. Values are
+# compared with a small tolerance as MySQL FLOAT columns don't keep every
+# decimal of a float64
+def unchanged_rows(batch, existing):
+    if len(existing) == 0:
+        return np.zeros(len(batch), dtype=bool), np.zeros(len(batch), dtype=bool)
+    pos = np.minimum(np.searchsorted(existing.epoch, batch.epoch), len(existing) - 1)
+    found = existing.epoch[pos] == batch.epoch
+    same = found.copy()
+    for i, col in enumerate(batch.columns):
+        same &= np.isclose(batch.values[:, i], existing.column(col)[pos], rtol=1e-6, atol=1e-9, equal_nan=True)
+    return found, same
+
+# write 'rows' (Observations or a dataframe) to 'table' in a single
+# transaction, 'batch_size' rows per statement. A row whose DateTime is
+# already on SQL is updated if its values changed and skipped otherwise, so
+# messages received twice, out of order or a run that crashed half way never
+# create duplicates or gaps. Returns the number of rows inserted, updated
+# and skipped, and under 'written' the DateTimes of the rows inserted or
+# updated (datetime64 array)
+def upsert(engine, table, rows, batch_size=BATCH_SIZE, key='DateTime'):
+    tbl = get_table(engine, table)
+    unique = key == 'DateTime' and datetime_is_unique(engine, table)
+    if not isinstance(rows, Observations):
+        rows = Observations.from_frame(rows, key)
+    rows = rows.unique()
+    counts = {'inserted': 0, 'updated': 0, 'skipped': 0}
+    if len(rows) == 0:
+        counts['written'] = np.array([], dtype='datetime64[ns]')
+        return counts
+    written = []
+
+    with swarm_metrics.stage('sql_write', table=table), engine.begin() as con:
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start+batch_size]
+            dt = batch.datetimes()
+
+            # rows already on SQL for the time range of this batch
+            sql = sa.select(tbl.c[key], *[tbl.c[col] for col in batch.columns]).where(
+                tbl.c[key].between(pd.Timestamp(dt[0]).to_pydatetime(), pd.Timestamp(dt[-1]).to_pydatetime()))
+            existing = Observations.from_frame(pd.read_sql_query(sql=sql, con=con, parse_dates=[key]), key).unique()
+
+            found, same = unchanged_rows(batch, existing)
+            changed = found & ~same
+            if (~found).any():
+                con.execute(insert_statement(con, tbl, batch.columns, key, unique), batch[~found].records())
+            if changed.any():
+                con.execute(tbl.update().where(tbl.c[key] == sa.bindparam('_key')), batch[changed].records('_key'))
+
+            written.append(dt[~same])
+            counts['inserted'] += int((~found).sum())
+            counts['updated'] += int(changed.sum())
+            counts['skipped'] += int(same.sum())
+    for op, n in counts.items():
+        swarm_metrics.add('swarm_rows_total', n, table=table, op=op)
+    counts['written'] = np.concatenate(written)
+    return counts
+
+# same as read_since() but yields the rows oldest first in chunks of
+# 'chunksize' rows through a server-side cursor, so a whole table can be
+# read in constant memory
+def stream_since(engine, table, since=None, chunksize=10000, columns='*'):
+    if since is None:
+        sql = sa.text('SELECT %s FROM %s ORDER BY DateTime' %(columns, table))
+        params = {}
+    else:
+        sql = sa.text('SELECT %s FROM %s WHERE DateTime > :since ORDER BY DateTime' %(columns, table))
+        sql = sql.bindparams(sa.bindparam('since', type_=sa.DateTime()))
+        params = {'since': pd.Timestamp(since).to_pydatetime()}
+    with engine.connect() as con:
+        con = con.execution_options(stream_results=True)
+        for chunk in pd.read_sql_query(sql=sql, con=con, params=params, chunksize=chunksize,
+                                       parse_dates=['DateTime']):
+            yield chunk
+
+def main():
+    parser = argparse.ArgumentParser(description='Set up the DateTime indexes of the SWARM SQL tables')
+    sub = parser.add_subparsers(dest='command')
+    idx = sub.add_parser('index', help="index DateTime, on every 'raw' and 'clean' table by default")
+    idx.add_argument('tables', nargs='*')
+    args = parser.parse_args()
+
+    if args.command is None:
+        parser.print_help()
+        return
+    from swarm_stations import STATIONS
+    tables = args.tables or [info[key] for info in STATIONS.values() for key in ('raw_table', 'clean_table')]
+
+    # Establish a connection with MySQL database 'viuhydro_wx_data_v2'
+    # Server log-in details stored in config file
+    import config
+    engine = config.main_sql()
+    for table in tables:
+        unique = create_datetime_index(engine, table)
+        print('%s: %s DateTime index' %(table, 'unique' if unique else 'non-unique'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+# version 1.0.0
+
+# Wx stations sending data to the Bumblebee SWARM account. Each station is
+# identified in the message by its 'key': a label in the first column for the
+# Stephanie stations ('S6', 'S9') or the lat/lon pair in the first two columns
+# for Mt Maya, matched within 'tolerance' metres (see StationIndex). Note
+# Steph 9 is Upper Russell in the SQL database.
+#
+# The 'layout' describes how the hourly records are packed in a message once
+# the 'skip' leading label columns are dropped: the position of the year,
+# month and day columns, the position of the hour of each slot (one per
+# hourly record in the message) and the 'raw' SQL columns following each hour.
+# Its 'binary' entry gives the station id sent in the binary messages and
+# the number of decimals kept for each column (see swarm_binary.py)
+#
+# 'clean' lists, in order, how each 'clean' SQL column is computed from the
+# 'raw' SQL columns (see swarm_clean.py):
+#   {'raw': col}                                  copy of a raw column
+#   {'raw': col, 'scale': k, 'offset': c}         unit conversion k*col + c
+#   {'raw': col, 'diff': k}                       k*(col - previous col)
+#   {'derive': 'water_year'}                      water year from DateTime
+#   {'value': v}                                  constant value
+# and 'round' rounds the result to that many decimals
+#
+# 'rollup' lists the aggregates ('sum', 'min', 'max', 'mean') of the 'clean'
+# columns kept per day and per water year (see swarm_rollup.py)
+#
+# 'qc' holds the periods excluded from the 'raw' SQL database and the range,
+# rate of change and stuck sensor checks of its columns (see swarm_qc.py)
+
+import numpy as np
+import pandas as pd
+
+from swarm_paths import STATION_NAMES
+
+# lon/lat sent by Maya
+MAYA_LAT = '52.287217'
+MAYA_LON = '-126.073550'
+
+STATIONS = {
+    'mountmaya': {'key': (MAYA_LAT, MAYA_LON),
+                  'raw_table': 'raw_mountmaya',
+                  'clean_table': 'clean_mountmaya',
+                  'daily_table': 'daily_mountmaya',
+                  'watyr_table': 'watyr_mountmaya',
+                  'layout': {'skip': 0,
+                             'date_cols': [2,3,4],
+                             'hour_cols': [5],
+                             'columns': ['BattV_Avg','AirTC_Avg','RH_Avg','TCDT_Avg',
+                                         'WS_ms_Avg','WS_ms_Max','WindDir_D1_WVT',
+                                         'WindDir_SD1_WVT','Rain_mm_Tot','BaroP_Avg',
+                                         'SolarRad_Avg','PrecipGaugeLvl_Avg'],
+                             'binary': {'id': 1,
+                                        'decimals': [2,2,1,3,2,2,1,1,1,1,1,3]}},
+                  'clean': [('WatYr', {'derive': 'water_year'}),
+                            ('Air_Temp', {'raw': 'AirTC_Avg'}),
+                            ('RH', {'raw': 'RH_Avg'}),
+                            ('BP', {'raw': 'BaroP_Avg'}),
+                            ('Wind_speed', {'raw': 'WS_ms_Avg', 'scale': 3.6}), # convert m/s to km/h
+                            ('Wind_Dir', {'raw': 'WindDir_D1_WVT'}),
+                            ('Pk_Wind_Speed', {'raw': 'WS_ms_Max', 'scale': 3.6}), # convert m/s to km/h
+                            ('PP_Tipper', {'raw': 'Rain_mm_Tot'}),
+                            ('PC_Raw_Pipe', {'raw': 'PrecipGaugeLvl_Avg', 'scale': 1000}),
+                            ('PP_Pipe', {'raw': 'PrecipGaugeLvl_Avg', 'diff': 1000}),
+                            # convert "distance to snow" to snow depth by substracting height of
+                            # instrument above summer ground (3.8 m) and convert to cm
+                            ('Snow_Depth', {'raw': 'TCDT_Avg', 'scale': -100, 'offset': 380, 'round': 2}),
+                            ('Solar_Rad', {'raw': 'SolarRad_Avg'}),
+                            ('Batt', {'raw': 'BattV_Avg'})],
+                  'rollup': {'Air_Temp': ['min', 'max', 'mean'],
+                             'RH': ['mean'],
+                             'Wind_speed': ['mean'],
+                             'Pk_Wind_Speed': ['max'],
+                             'PP_Tipper': ['sum'],
+                             'PP_Pipe': ['sum'],
+                             'Snow_Depth': ['mean'],
+                             'Solar_Rad': ['mean']},
+                  # July 13 2023 is erroneous
+                  'qc': {'exclude': [('2023-07-13', '2023-07-14')],
+                         'action': 'null',
+                         'fields': {'BattV_Avg': {'min': 0, 'max': 20},
+                                    'AirTC_Avg': {'min': -50, 'max': 50, 'rate': 15, 'stuck': 12},
+                                    'RH_Avg': {'min': 0, 'max': 105},
+                                    'TCDT_Avg': {'min': 0, 'max': 10},
+                                    'WS_ms_Avg': {'min': 0, 'max': 75},
+                                    'WS_ms_Max': {'min': 0, 'max': 100},
+                                    'WindDir_D1_WVT': {'min': 0, 'max': 360},
+                                    'Rain_mm_Tot': {'min': 0, 'max': 100},
+                                    'SolarRad_Avg': {'min': -10, 'max': 1500}}}},
+    'steph6': {'key': 'S6',
+               'raw_table': 'raw_steph6',
+               'clean_table': 'clean_steph6',
+               'daily_table': 'daily_steph6',
+               'watyr_table': 'watyr_steph6',
+               'layout': {'skip': 1,
+                          'date_cols': [0,1,2],
+                          'hour_cols': [3,16],
+                          'columns': ['Batt','Air_Temp','RH','Snow_Depth','Wind_speed',
+                                      'Pk_Wind_Speed','Wind_Dir','Wind_Dir_SD','PP_Tipper',
+                                      'BP','Solar_Rad','PC_Raw_Pipe'],
+                          'binary': {'id': 6,
+                                     'decimals': [2,2,1,3,2,2,1,1,1,1,1,3]}},
+               'clean': [('WatYr', {'derive': 'water_year'}),
+                         ('Batt', {'raw': 'Batt'}),
+                         ('Air_Temp', {'raw': 'Air_Temp'}),
+                         ('RH', {'raw': 'RH'}),
+                         ('Wind_Speed', {'raw': 'Wind_speed'}),
+                         ('Pk_Wind_Speed', {'raw': 'Pk_Wind_Speed'}),
+                         ('Wind_Dir', {'raw': 'Wind_Dir'}),
+                         ('Solar_Rad', {'raw': 'Solar_Rad'}),
+                         # distance to ground conversion (m to cm)
+                         ('Snow_Depth', {'raw': 'Snow_Depth', 'scale': -100, 'offset': 379, 'round': 2}),
+                         ('PP_Tipper', {'raw': 'PP_Tipper'}),
+                         ('PC_Raw_Pipe', {'raw': 'PC_Raw_Pipe', 'scale': 1000}), # convert to mm
+                         ('BP', {'value': np.nan})], # in kpa but needs fixing first - Sergey is on it
+               'rollup': {'Air_Temp': ['min', 'max', 'mean'],
+                          'RH': ['mean'],
+                          'Wind_Speed': ['mean'],
+                          'Pk_Wind_Speed': ['max'],
+                          'PP_Tipper': ['sum'],
+                          'Snow_Depth': ['mean'],
+                          'Solar_Rad': ['mean']},
+               'qc': {'action': 'null',
+                      'fields': {'Batt': {'min': 0, 'max': 20},
+                                 'Air_Temp': {'min': -50, 'max': 50, 'rate': 15, 'stuck': 12},
+                                 'RH': {'min': 0, 'max': 105},
+                                 'Snow_Depth': {'min': 0, 'max': 10},
+                                 'Wind_speed': {'min': 0, 'max': 75},
+                                 'Pk_Wind_Speed': {'min': 0, 'max': 100},
+                                 'Wind_Dir': {'min': 0, 'max': 360},
+                                 'PP_Tipper': {'min': 0, 'max': 100},
+                                 'Solar_Rad': {'min': -10, 'max': 1500}}}},
+    'upperrussell': {'key': 'S9',
+                     'raw_table': 'raw_upperrussell',
+                     'clean_table': 'clean_upperrussell',
+                     'daily_table': 'daily_upperrussell',
+                     'watyr_table': 'watyr_upperrussell',
+                     'layout': {'skip': 1,
+                                'date_cols': [0,1,2],
+                                'hour_cols': [3,12],
+                                'columns': ['Batt','Air_Temp','RH','PP_Tipper','PP_Tipper_cnt',
+                                            'PC_Raw_Pipe','River_Thick','River_Thick_SD'],
+                                'binary': {'id': 9,
+                                           'decimals': [2,2,1,1,0,3,3,3]}},
+                     'clean': [('WatYr', {'derive': 'water_year'}),
+                               ('Batt', {'raw': 'Batt'}),
+                               ('Air_Temp', {'raw': 'Air_Temp'}),
+                               ('RH', {'raw': 'RH'}),
+                               ('PP_Tipper', {'raw': 'PP_Tipper'}),
+                               ('PC_Raw_Pipe', {'raw': 'PC_Raw_Pipe', 'scale': 1000})], # convert to mm
+                     'rollup': {'Air_Temp': ['min', 'max', 'mean'],
+                                'RH': ['mean'],
+                                'PP_Tipper': ['sum']},
+                     'qc': {'action': 'null',
+                            'fields': {'Batt': {'min': 0, 'max': 20},
+                                       'Air_Temp': {'min': -50, 'max': 50, 'rate': 15, 'stuck': 12},
+                                       'RH': {'min': 0, 'max': 105},
+                                       'PP_Tipper': {'min': 0, 'max': 100}}}},
+    }
+
+# swarm.py lists the stations without importing this module
+if list(STATIONS) != STATION_NAMES:
+    raise ValueError('swarm_paths.STATION_NAMES must list the stations of STATIONS: %s' %(list(STATIONS)))
+
+# number of values in a message of this layout (label columns excluded)
+def layout_ncols(layout):
+    return layout['hour_cols'][-1] + 1 + len(layout['columns'])
+
+# distance (m) from its position within which a message is still routed to
+# a station sending its lat/lon, as the GPS position jitters. A station can
+# set its own 'tolerance'
+TOLERANCE = 100.0
+
+# metres per degree of latitude
+METRES_PER_DEGREE = 111320.0
+
+# text to float, NaN for anything that is not a number
+def to_float(values):
+    try:
+        return np.array(values.tolist(), dtype=float)
+    except ValueError:
+        return pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype=float)
+
+# registry of the stations used to route the messages: a dict for the
+# stations sending a label and, for those sending their lat/lon, the
+# positions (in metres) sorted by latitude so the stations near a message
+# are found with a binary search. Routing a batch is one vectorized lookup
+# whatever the number of stations. Binary messages carry the station id in
+# their second byte
+class StationIndex(object):
+
+    def __init__(self, stations=None, tolerance=TOLERANCE):
+        if stations is None:
+            stations = list(STATIONS)
+        self.labels = {}
+        self.ids = {}
+        coords = []
+        for name in stations:
+            if 'binary' in STATIONS[name]['layout']:
+                self.ids[STATIONS[name]['layout']['binary']['id']] = name
+            key = STATIONS[name]['key']
+            if isinstance(key, tuple):
+                coords.append((float(key[0]), float(key[1]), STATIONS[name].get('tolerance', tolerance), name))
+            else:
+                self.labels[key] = name
+        coords.sort()
+        self.lat = np.array([c[0] for c in coords])
+        self.lon = np.array([c[1] for c in coords])
+        self.tolerance = np.array([c[2] for c in coords])
+        self.names = np.array([c[3] for c in coords] + [None], dtype=object)
+        self.y = self.lat*METRES_PER_DEGREE
+        self.window = self.tolerance.max() if len(coords) > 0 else 0.0
+
+    # index of the nearest station within its tolerance of each lat/lon,
+    # len(self.lat) if there is none
+    def nearest(self, lat, lon):
+        y = lat*METRES_PER_DEGREE
+        lo = np.searchsorted(self.y, y - self.window, side='left')
+        hi = np.searchsorted(self.y, y + self.window, side='right')
+        best = np.full(len(y), len(self.lat))
+        best_dist = np.full(len(y), np.inf)
+        # stations within the latitude window of each message, one at a time
+        for j in range(int(np.max(hi - lo, initial=0))):
+            cand = lo + j
+            ok = cand < hi
+            c = np.where(ok, cand, 0)
+            dx = (lon - self.lon[c])*METRES_PER_DEGREE*np.cos(np.radians(lat))
+            dist = np.hypot(y - self.y[c], dx)
+            better = ok & (dist <= self.tolerance[c]) & (dist < best_dist)
+            best = np.where(better, c, best)
+            best_dist = np.where(better, dist, best_dist)
+        return best
+
+    # station of each message from its first two columns (label, or lat and
+    # lon), None for messages from unknown stations
+    def lookup(self, first, second):
+        names = np.array([self.labels.get(label) for label in first], dtype=object)
+        todo = np.flatnonzero(pd.isnull(names))
+        if len(self.lat) > 0 and len(todo) > 0:
+            lat = to_float(np.asarray(first, dtype=object)[todo])
+            lon = to_float(np.asarray(second, dtype=object)[todo])
+            names[todo] = self.names[self.nearest(lat, lon)]
+        return names
+
+    # station of each decoded message (text or binary), see lookup()
+    def route(self, payloads):
+        binary = np.array([isinstance(p, bytes) for p in payloads], dtype=bool)
+        if not binary.any():
+            keys = [p.split(',', 2) for p in payloads]
+            return self.lookup([k[0] for k in keys], [k[1] if len(k) > 1 else '' for k in keys])
+
+        names = np.full(len(payloads), None, dtype=object)
+        text = np.flatnonzero(~binary)
+        if len(text) > 0:
+            keys = [payloads[i].split(',', 2) for i in text]
+            names[text] = self.lookup([k[0] for k in keys], [k[1] if len(k) > 1 else '' for k in keys])
+        for i in np.flatnonzero(binary):
+            names[i] = self.ids.get(payloads[i][1]) if len(payloads[i]) > 1 else None
+        return names